@@ -0,0 +1,89 @@
+"""
+Benchmarks the OCR workers on a folder of images.
+
+    python bench_ocr.py <folder> [--engine both|pytesseract|tesserocr] [--workers N] [--runs N]
+                        [--preprocess '{"threshold": true}']
+
+Every image is submitted ``runs`` times through the same OCRScheduler the site uses, once per engine: ``pytesseract``
+spawns tesseract for every image, ``tesserocr`` keeps one loaded instance per worker. The throughput and the p50/p99
+latency per image are reported side by side. If an image has a ``<name>.txt`` file next to it with the expected text,
+the character accuracy of the results is reported too, so preprocessing settings can be compared on the same images.
+"""
+import argparse
+import asyncio
+import difflib
+import json
+import pathlib
+import time
+from typing import List, Optional
+
+from utils import ocr
+from utils.analytics import percentile
+
+EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".gif"}
+
+async def bench(engine: str, images: List[pathlib.Path], args) -> dict:
+    scheduler = ocr.OCRScheduler(
+        asyncio.get_running_loop(), workers=args.workers, queue_size=len(images) * args.runs, per_user=args.workers,
+        preprocess=json.loads(args.preprocess) if args.preprocess else None, engine=engine
+    )
+
+    async def run(path: pathlib.Path):
+        start = time.perf_counter()
+        text = await scheduler.submit("bench", ocr._do_img, path.read_bytes())
+        return path, text, time.perf_counter() - start
+
+    try:
+        await asyncio.gather(*(run(images[0]) for _ in range(args.workers))) # start the workers, so their startup isn't counted
+        start = time.perf_counter()
+        results = await asyncio.gather(*(run(p) for _ in range(args.runs) for p in images))
+        elapsed = time.perf_counter() - start
+    finally:
+        scheduler.pool.shutdown()
+
+    scores = []
+    for path, text, _ in results[:len(images)]:
+        expected = path.with_suffix(".txt")
+        if expected.exists():
+            scores.append(difflib.SequenceMatcher(None, " ".join((text or "").split()), " ".join(expected.read_text().split())).ratio())
+
+    latencies = [r[2] for r in results]
+    return {
+        "images": len(results),
+        "throughput": len(results) / elapsed,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "accuracy": sum(scores) / len(scores) if scores else None
+    }
+
+def row(name: str, values: List[Optional[str]]) -> str:
+    return f"{name:<14}" + "".join(f"{v or '-':>14}" for v in values)
+
+async def main(args):
+    images = sorted(p for p in pathlib.Path(args.folder).iterdir() if p.suffix.lower() in EXTENSIONS)
+    if not images:
+        print(f"no images found in {args.folder}")
+        return
+
+    engines = ["pytesseract", "tesserocr"] if args.engine == "both" else [args.engine]
+    if "tesserocr" in engines and ocr.tesserocr is None:
+        print("tesserocr is not installed, skipping it")
+        engines.remove("tesserocr")
+
+    results = [await bench(engine, images, args) for engine in engines]
+
+    print(f"{len(images)} images x {args.runs} runs with {args.workers} workers")
+    print(row("", engines))
+    print(row("images/s", [f"{r['throughput']:.2f}" for r in results]))
+    print(row("latency p50", [f"{r['p50'] * 1000:.0f}ms" for r in results]))
+    print(row("latency p99", [f"{r['p99'] * 1000:.0f}ms" for r in results]))
+    print(row("accuracy", [r['accuracy'] is not None and f"{r['accuracy']:.3f}" or None for r in results]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("folder")
+    parser.add_argument("--engine", choices=("both", "pytesseract", "tesserocr"), default="both")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--preprocess", help="ocr_preprocess overrides, as json")
+    asyncio.run(main(parser.parse_args()))
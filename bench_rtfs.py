@@ -0,0 +1,74 @@
+"""
+Benchmarks the rtfs FuzzyIndex against a plain difflib.get_close_matches over the same names.
+
+    python bench_rtfs.py [package] [--queries N] [--seed N]
+
+``package`` is an importable package to index (discord by default). Queries are names from the index with typos,
+dropped characters and changed case applied, plus some names that don't exist. The p50/p99 latency of both is reported,
+along with how many of difflib's top 3 results FuzzyIndex also returns.
+"""
+import argparse
+import asyncio
+import difflib
+import importlib
+import os
+import random
+import time
+
+from utils.analytics import percentile
+from utils.rtfs import Index
+
+def mutate(rng: random.Random, key: str) -> str:
+    key = list(key)
+    for _ in range(rng.randint(0, 2)):
+        op = rng.choice(("drop", "swap", "case"))
+        i = rng.randrange(len(key))
+        if op == "drop" and len(key) > 3:
+            del key[i]
+        elif op == "swap" and i < len(key) - 1:
+            key[i], key[i + 1] = key[i + 1], key[i]
+        elif op == "case":
+            key[i] = key[i].swapcase()
+
+    return "".join(key)
+
+def timed(func, queries: list) -> tuple:
+    results, latencies = [], []
+    for q in queries:
+        start = time.perf_counter()
+        results.append(func(q))
+        latencies.append(time.perf_counter() - start)
+
+    return results, latencies
+
+async def main(args):
+    package = importlib.import_module(args.package)
+    root, folder = os.path.split(os.path.dirname(package.__file__))
+    index = Index(root, folder, "")
+    start = time.perf_counter()
+    await index.index_lib()
+    print(f"indexed {len(index.keys)} names from {args.package} in {time.perf_counter() - start:.2f}s")
+
+    rng = random.Random(args.seed)
+    queries = [mutate(rng, rng.choice(index.keys)) for _ in range(args.queries)]
+    queries += ["".join(rng.choices("abcdefghijklmnopqrstuvwxyz_", k=rng.randint(4, 16))) for _ in range(args.queries // 10)]
+
+    fuzzy, fuzzy_latency = timed(lambda q: index.matcher.find(q, limit=3, cutoff=0.55), queries)
+    plain, plain_latency = timed(lambda q: difflib.get_close_matches(q, index.keys, n=3, cutoff=0.55), queries)
+
+    for name, latencies in (("FuzzyIndex", fuzzy_latency), ("difflib", plain_latency)):
+        print(f"{name:>10}: p50 {percentile(latencies, 0.5) * 1000:.3f}ms, p99 {percentile(latencies, 0.99) * 1000:.3f}ms")
+
+    found = expected = 0
+    for a, b in zip(fuzzy, plain):
+        found += len(set(a) & set(b))
+        expected += len(b)
+
+    print(f"top 3 overlap: {found}/{expected} ({found / expected if expected else 1:.1%}) of difflib's results")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("package", nargs="?", default="discord")
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -1,10 +1,12 @@
-import random
+import asyncio
+import base64
+import collections
 import datetime
 import aiohttp
-import itertools
-import time
-import mimetypes
 import json
+import logging
+import mimetypes
+from typing import Any, Callable, List
 
 import asyncpg
 import yarl
@@ -12,24 +14,19 @@ import yarl
 from aiohttp import web
 
 from utils import handler, app
+from utils.cdn import delete, expiry, nodes, upload
 
 router = web.RouteTableDef()
+logger = logging.getLogger("site.cdn")
 
 @router.get("/api/cdn")
 @handler.ratelimit(20, 60)
 async def get_cdn_stats(request: app.TypedRequest, conn: asyncpg.Connection):
-    amount = await conn.fetchrow("""
-    SELECT
-        (SELECT COUNT(*) FROM uploads WHERE deleted is false) AS allcount,
-        (SELECT COUNT(*) FROM uploads WHERE time > ((now() at time zone 'utc') - INTERVAL '1 day')) AS todaycount,
-        (SELECT cast('https://{child_site}/' as text) || slaves.name || cast('/' as text) || uploads.key FROM uploads INNER JOIN slaves ON 
-            slaves.node = uploads.node ORDER BY time DESC LIMIT 1) as last_upload;
-    """)
-
+    stats = request.app.cdn_stats
     return web.json_response({
-        "upload_count": amount['allcount'],
-        "uploaded_today": amount['todaycount'],
-        "last_upload": amount['last_upload'].format(child_site=request.app.settings['child_site'])
+        "upload_count": stats.total,
+        "uploaded_today": stats.today,
+        "last_upload": stats.last_upload and f"https://{request.app.settings['child_site']}/{stats.last_upload[0]}/{stats.last_upload[1]}"
     })
 
 async def upload_media_to_slaves(
@@ -44,124 +41,165 @@ async def upload_media_to_slaves(
         allowed_access: list=None,
         expiry: datetime.datetime=None
     ):
-    url = yarl.URL(f"http://{target['ip']}").with_port(target['port']).with_path("create")
-    if new_filename:
-        url = url.with_query(name=new_filename)
-
-    async with aiohttp.ClientSession() as session: # cant use a global session because that would limit us to one at a time
-        # also i cant be asked to make a clientsession pool
-        async with session.post(url, data=stream,
-                                headers={
-                                    "Authorization": app.settings['slave_key'],
-                                    "Content-Type": content_type,
-                                    "File-Name": filename
-                                }) as resp:
-            if resp.status == 600:
-                return False, await resp.text()
-            elif 100 >= resp.status >= 300:
-                return False, await resp.text()
-            else:
-                data = await resp.text()
-                data = json.loads(data)
-                new_name = data['name']
-                path = data['path']
-                node = data['node']
-                size = data['size']
-
+    try:
+        data = await app.cdn_uploads.upload(target, stream, content_type, filename, new_filename)
+    except (upload.UploadTooLarge, upload.UploadTimeout) as e:
+        return False, type(e).__name__
+    except upload.NodeError as e:
+        return False, e.text
+
+    new_name = data['name']
+    path = data['path']
+    node = data['node']
+    size = data['size']
+
+    now = datetime.datetime.utcnow()
     await conn.execute(
         "INSERT INTO uploads VALUES ($1,$2,$3,0,$4,$5,$6,false,$7,$8)",
-        new_name, user, datetime.datetime.utcnow(), allowed_access, path, node, size, expiry
+        new_name, user, now, allowed_access, path, node, size, expiry
     )
+    app.cdn_stats.uploaded(user, target['name'], new_name, now)
     return True, f"https://{app.settings['child_site']}/{target['name']}/{new_name}"
 
 @router.post("/api/cdn")
-@handler.ratelimit(3, 7)
-async def post_media(request: app.TypedRequest, conn: asyncpg.Connection):
+@handler.ratelimit(3, 7, hold_connection=False)
+async def post_media(request: app.TypedRequest, _: asyncpg.Pool):
     allowed_auths = request.query.getall("authorized", None)
     target: str = request.query.get("node", None)
 
     if "content-type" not in request.headers and "file-name" not in request.headers:
         return web.Response(status=400, reason="Bad request. Missing a MIME type or 'file-name' header.")
 
+    if request.content_length is not None and request.content_length > request.app.cdn_uploads.max_size:
+        return web.Response(status=413, reason="Upload is too large")
+
     if "content-type" in request.headers:
-        f_name = "file." + mimetypes.guess_extension(request.headers['content-type'].split(";")[0].strip())
+        f_name = "file" + (mimetypes.guess_extension(request.headers['content-type'].split(";")[0].strip()) or ".bin")
     else:
         f_name = request.headers['file-name']
 
-    if target and "cdn.manage" in request.user['permissions']:
-        name: str = request.query.get("name", None)
+    replicas = request.app.settings.get("cdn_replicas", 1)
+    if "replicas" in request.query:
+        try:
+            replicas = int(request.query['replicas'])
+        except ValueError:
+            return web.Response(status=400, reason="replicas must be an integer")
 
-        if target.isnumeric():
-            target: int = int(target)
-            if target not in request.app.slaves:
-                return web.Response(status=400, reason="The specified node is not available")
+        if not 1 <= replicas <= request.app.settings.get("cdn_max_replicas", 3):
+            return web.Response(status=400, reason=f"replicas must be between 1 and {request.app.settings.get('cdn_max_replicas', 3)}")
 
-            target: dict = request.app.slaves[target]
-        else:
-            for _node in request.app.slaves.values():
-                if _node['name'].lower() == target.lower():
-                    target: dict = _node
-                    break
+    options = [y for y in request.app.cdn_nodes.upload_nodes() if y['name'] not in request.app.settings['slave_no_balancing']]
+    if target and "cdn.manage" in request.user['permissions']:
+        name: str = request.query.get("name", None)
 
-        if type(target) is str:
+        target: dict = request.app.cdn_nodes.get(target)
+        if target is None or target not in request.app.cdn_nodes.upload_nodes():
             return web.Response(status=400, reason="The specified node is not available")
 
-        elif time.time() - target['signin'] > 300:
-            return web.Response(status=400, reason="The specified node is not available")
+        options = [y for y in options if y is not target]
+        targets = [target] + nodes.choose_nodes(
+            options,
+            request.app.cdn_uploads.inflight,
+            replicas - 1,
+            request.app.settings.get("cdn_min_free_space", nodes.GB)
+        )
 
     else:
         name = None
-        t = time.time()
-        options = {x: y for x, y in request.app.slaves.items() if t-y['signin'] < 300 and y['name'] not in request.app.settings['slave_no_balancing']}
-        if not options:
+        targets = nodes.choose_nodes(
+            options,
+            request.app.cdn_uploads.inflight,
+            replicas,
+            request.app.settings.get("cdn_min_free_space", nodes.GB)
+        )
+        if not targets:
             return web.Response(status=503, reason="Error: no nodes available")
 
-        target = random.choice(list(options.keys()))
-        target = options[target]
-
-    url = yarl.URL(f"http://{target['ip']}").with_port(target['port']).with_path("create")
-        # use http to directly access the backend, cuz it probably isnt behind nginx
-
-    if name is not None:
-        url = url.with_query(name=name)
-
-    async with aiohttp.ClientSession() as session: # cant use a global session because that would limit us to one at a time
-        # also i cant be asked to make a clientsession pool
-        ct = mimetypes.guess_type(f_name, False)
-        if not ct:
-            ct = "text/plain"
+    ct = mimetypes.guess_type(f_name, False)[0] or "text/plain"
+    try:
+        if len(targets) == 1:
+            results = [await request.app.cdn_uploads.upload(targets[0], request.content, ct, f_name, name)]
         else:
-            ct = ct[0]
-        async with session.post(url, data=request.content,
-                                headers={
-                                    "Authorization": request.app.settings['slave_key'],
-                                    "Content-Type": ct,
-                                    "File-Name": f_name
-                                }) as resp:
-            if resp.status == 600:
-                return web.Response(status=400, reason=f"child node error: {await resp.text()}")
-            elif 100 >= resp.status >= 300:
-                return web.Response(status=500, reason=f"child node error: {await resp.text()}")
-            else:
-                data = await resp.text()
-                data = json.loads(data)
-                new_name = data['name']
-                path = data['path']
-                node = data['node']
-                size = data['size']
+            results = await request.app.cdn_uploads.replicate(targets, request.content, ct, f_name, name)
+    except upload.UploadTooLarge:
+        return web.Response(status=413, reason="Upload is too large")
+    except upload.UploadTimeout:
+        return web.Response(status=408, reason="Upload timed out")
+    except Exception as e:
+        results = [e]
+
+    stored = []
+    for node, result in zip(targets, results):
+        if isinstance(result, dict):
+            stored.append((node, result))
+        elif isinstance(result, aiohttp.ClientError) or (isinstance(result, upload.NodeError) and 500 <= result.status < 600):
+            request.app.cdn_nodes.record_failure(node)
+
+    if not stored:
+        error = results[0]
+        if isinstance(error, upload.UploadTimeout):
+            return web.Response(status=408, reason="Upload timed out")
+        if isinstance(error, upload.NodeError):
+            return web.Response(status=400 if error.status == 600 else 500, reason=str(error))
+        if isinstance(error, aiohttp.ClientError):
+            return web.Response(status=502, reason="The cdn node could not be reached")
+        raise error
+
+    if len(stored) < len(targets):
+        logger.warning(f"Upload stored on {len(stored)} of {len(targets)} requested nodes")
+
+    target, data = stored[0]
+    new_name = data['name']
+    path = data['path']
+    node = data['node']
+    size = data['size']
+
+    now = datetime.datetime.utcnow()
+    async with request.app.db.acquire() as conn, conn.transaction():
+        await conn.execute(
+            "INSERT INTO uploads VALUES ($1,$2,$3,0,$4,$5,$6,false,$7)",
+            new_name, request.user['username'], now, allowed_auths, path, node, size
+        )
+        if len(stored) > 1:
+            await conn.executemany(
+                "INSERT INTO upload_replicas VALUES ($1, $2, $3, $4)",
+                [(new_name, node, replica['node'], replica['name']) for _, replica in stored[1:]]
+            )
 
-    await conn.execute(
-        "INSERT INTO uploads VALUES ($1,$2,$3,0,$4,$5,$6,false,$7)",
-        new_name, request.user['username'], datetime.datetime.utcnow(), allowed_auths, path, node, size
-    )
-    request.app.last_upload = f"https://{request.app.settings['child_site']}/{target['name']}/{new_name}"
+    request.app.cdn_stats.uploaded(request.user['username'], target['name'], new_name, now)
 
     return web.json_response({
         "url": f"https://{request.app.settings['child_site']}/{target['name']}/{new_name}",
         "slug": new_name,
-        "node": target['name']
+        "node": target['name'],
+        "replicas": [f"https://{request.app.settings['child_site']}/{n['name']}/{d['name']}" for n, d in stored[1:]]
     }, status=201)
 
+@router.get("/api/cdn/{node}/{slug}/raw")
+@handler.ratelimit(60, 60)
+async def get_upload_replica(request: app.TypedRequest, conn: asyncpg.Connection):
+    """
+    Redirects to the copy of an upload on its healthiest node.
+    """
+    rows = await conn.fetch("""
+    SELECT uploads.node, uploads.key FROM uploads
+    INNER JOIN slaves ON slaves.node = uploads.node
+    WHERE slaves.name = $1 AND uploads.key = $2 AND deleted IS false
+    UNION ALL
+    SELECT upload_replicas.replica, upload_replicas.replica_key FROM upload_replicas
+    INNER JOIN uploads ON uploads.key = upload_replicas.key AND uploads.node = upload_replicas.node
+    INNER JOIN slaves ON slaves.node = uploads.node
+    WHERE slaves.name = $1 AND uploads.key = $2 AND deleted IS false
+    """, request.match_info['node'], request.match_info['slug'])
+    if not rows:
+        return web.Response(status=404)
+
+    keys = {r['node']: r['key'] for r in rows}
+    target = request.app.cdn_nodes.healthiest(list(keys), request.app.cdn_uploads.inflight)
+    if target is None:
+        return web.Response(status=503, reason="No node holding this file is available")
+
+    raise web.HTTPFound(f"https://{request.app.settings['child_site']}/{target['name']}/{keys[target['id']]}")
 
 @router.get("/api/cdn/{node}/{slug}")
 @handler.ratelimit(15, 60)
@@ -190,6 +228,12 @@ async def get_upload_stats(request: app.TypedRequest, conn: asyncpg.Connection):
     if not about:
         return web.Response(status=404)
 
+    replicas = await conn.fetch(
+        "SELECT slaves.name, replica_key FROM upload_replicas INNER JOIN slaves ON slaves.node = upload_replicas.replica "
+        "WHERE key = $1 AND upload_replicas.node = (SELECT slaves.node FROM slaves WHERE slaves.name = $2)",
+        key, node
+    )
+
     return web.json_response({
         "url": f"https://{request.app.settings['child_site']}/{about['name']}/{about['key']}",
         "timestamp": about['time'].timestamp(),
@@ -197,7 +241,8 @@ async def get_upload_stats(request: app.TypedRequest, conn: asyncpg.Connection):
         "views": about['views'],
         "node": about['name'],
         "size": about['size'],
-        "expiry": about['expiry'] and about['expiry'].isoformat()
+        "expiry": about['expiry'] and about['expiry'].isoformat(),
+        "replicas": [f"https://{request.app.settings['child_site']}/{r['name']}/{r['replica_key']}" for r in replicas]
     })
 
 
@@ -227,37 +272,63 @@ async def delete_image(request: app.TypedRequest, conn: asyncpg.Connection):
 
     if manage:
         coro = conn.fetchrow(
-            "UPDATE uploads SET deleted = true WHERE key = $1 AND node = $2 RETURNING *;",
+            "UPDATE uploads SET deleted = true WHERE key = $1 AND node = $2 AND deleted IS false RETURNING *;",
             request.match_info.get("slug"),
             target['id']
         )
 
     else:
         coro = conn.fetchrow(
-            "UPDATE uploads SET deleted = true WHERE key = $1 AND node = $2 AND username = $3 RETURNING *;",
+            "UPDATE uploads SET deleted = true WHERE key = $1 AND node = $2 AND username = $3 AND deleted IS false RETURNING *;",
             request.match_info.get("slug"),
             target['id'],
             auth
         )
 
-    if not await coro:
+    row = await coro
+    if not row:
         if manage:
             return web.Response(status=404)
 
         return web.Response(status=401, reason="401 Unauthorized (1002)")
 
     url = yarl.URL(f"http://{target['ip']}").with_port(target['port']).with_path("delete")
+    replicas = await conn.fetch(
+        "SELECT replica, replica_key FROM upload_replicas WHERE key = $1 AND node = $2",
+        request.match_info.get("slug"), target['id']
+    )
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-                url,
-                data=request.match_info.get("slug"),
-                headers={"Authorization": request.app.settings['slave_key']}
-        ) as resp:
-            if 200 >= resp.status > 300:
-                await conn.execute("UPDATE uploads SET deleted = false WHERE key = $1 and node = $2", request.match_info.get("slug"), target['id']) # undo
-
-            return web.Response(status=resp.status, reason=resp.reason)
+    async with aiohttp.ClientSession(
+            headers={"Authorization": request.app.settings['slave_key']},
+            timeout=aiohttp.ClientTimeout(total=30)
+    ) as session:
+        try:
+            async with session.post(url, data=request.match_info.get("slug")) as resp:
+                if not 200 <= resp.status < 300:
+                    await conn.execute("UPDATE uploads SET deleted = false WHERE key = $1 and node = $2", request.match_info.get("slug"), target['id']) # undo
+                    return web.Response(status=resp.status, reason=resp.reason)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # the file is still on the node, so it's still live, and its replicas are left alone
+            request.app.cdn_nodes.record_failure(target)
+            await conn.execute("UPDATE uploads SET deleted = false WHERE key = $1 and node = $2", request.match_info.get("slug"), target['id']) # undo
+            return web.Response(status=502, reason="The cdn node could not be reached")
+
+        request.app.cdn_stats.deleted(row['username'])
+
+        groups = collections.defaultdict(list)
+        for replica in replicas:
+            groups[replica['replica']].append(replica['replica_key'])
+
+        # one attempt each, the expiry sweeper retries whatever lands in the dead letters
+        results = await delete.delete_groups(session, request.app.cdn_nodes, groups, retries=1)
+
+    for node_id, chunks in results.items():
+        for keys, error in chunks:
+            if error is not None:
+                logger.warning(f"Could not delete {len(keys)} replicas from node {node_id}: {error}")
+                await expiry.dead_letter(conn, node_id, keys, error)
+
+    return web.Response(status=resp.status, reason=resp.reason)
 
 @router.post("/api/cdn/purge")
 @handler.ratelimit(0, 0)
@@ -270,21 +341,143 @@ async def purge_user(request: app.TypedRequest, conn: asyncpg.Connection):
     if request.app.test:
         return web.Response(status=204)
 
-    active_slaves = list(request.app.slaves.keys())
-    data = await conn.fetch("UPDATE uploads SET deleted = true WHERE username = $1 AND node = ANY($2) RETURNING *;", usr, active_slaves)
-    if not data:
-        return web.Response(status=400, reason="User not found/no images to delete")
+    async with conn.transaction():
+        data = await conn.fetch("UPDATE uploads SET deleted = true WHERE username = $1 AND deleted IS false RETURNING key, node;", usr)
+        if not data:
+            return web.Response(status=400, reason="User not found/no images to delete")
+
+        replicas = await conn.fetch("""
+        SELECT replica AS node, replica_key AS key FROM upload_replicas
+        INNER JOIN unnest($1::text[], $2::integer[]) AS p(key, node)
+            ON upload_replicas.key = p.key AND upload_replicas.node = p.node
+        """, [r['key'] for r in data], [r['node'] for r in data])
+
+    active_slaves = {n['id'] for n in request.app.cdn_nodes.available_nodes()}
+    groups = collections.defaultdict(list)
+    replica_groups = collections.defaultdict(list)
+    queued = collections.defaultdict(list) # files on unavailable nodes, left for the expiry sweeper
+    for r in data:
+        (groups if r['node'] in active_slaves else queued)[r['node']].append(r['key'])
+
+    for r in replicas:
+        (replica_groups if r['node'] in active_slaves else queued)[r['node']].append(r['key'])
+
+    for node_id, keys in queued.items():
+        await expiry.dead_letter(conn, node_id, keys, "node unavailable during purge")
+
+    async with aiohttp.ClientSession(headers={"Authorization": request.app.settings['slave_key']}) as session:
+        results, replica_results = await asyncio.gather(*(
+            delete.delete_groups(
+                session,
+                request.app.cdn_nodes,
+                g,
+                concurrency=request.app.settings.get("cdn_purge_concurrency", 4),
+                chunk_size=request.app.settings.get("cdn_purge_chunk_size", 1000)
+            )
+            for g in (groups, replica_groups)
+        ))
+
+    def entry_for(node_id: int) -> dict:
+        node = request.app.slaves.get(node_id)
+        return report.setdefault(node['name'] if node else str(node_id), {"deleted": 0, "failed": 0, "queued": 0, "errors": []})
+
+    report = {}
+    deleted = failed = queued_uploads = 0
+    for r in data:
+        if r['node'] not in active_slaves: # soft-deleted now, and removed from the node once it's back
+            entry_for(r['node'])['queued'] += 1
+            queued_uploads += 1
+
+    for node_id, chunks in results.items():
+        entry = entry_for(node_id)
+        for keys, error in chunks:
+            if error is None:
+                entry['deleted'] += len(keys)
+                continue
+
+            # the files are still on the node, so they're still live
+            await conn.execute("UPDATE uploads SET deleted = false WHERE key = ANY($1) AND node = $2", keys, node_id)
+            entry['failed'] += len(keys)
+            entry['errors'].append(error)
+
+        deleted += entry['deleted']
+        failed += entry['failed']
+
+    request.app.cdn_stats.deleted(usr, deleted + queued_uploads)
+
+    for node_id, chunks in replica_results.items():
+        for keys, error in chunks:
+            if error is None:
+                await conn.execute("DELETE FROM upload_replicas WHERE replica = $1 AND replica_key = ANY($2)", node_id, keys)
+            else:
+                logger.warning(f"Could not purge {len(keys)} replicas from node {node_id}: {error}")
+                await expiry.dead_letter(conn, node_id, keys, error)
+
+    return web.json_response(
+        {"deleted": deleted, "failed": failed, "queued": queued_uploads, "nodes": report},
+        status=200 if deleted or queued_uploads or not failed else 502
+    )
 
-    session = aiohttp.ClientSession(headers={"Authorization": request.app.settings['slave_key']})
+LIST_PAGE_SIZE = 1000
+LIST_MAX_PAGE_SIZE = 5000
+LIST_WRITE_SIZE = 64 * 1024
 
-    for group, vals in itertools.groupby(data, key=lambda r: r['node']):
-        node = request.app.slaves[group]
-        url = yarl.URL(f"http://{node['ip']}").with_port(node['port']).with_path("mass-delete") # TODO: mass delete on slave end
-        async with session.post(url, json={"ids": [x['id'] for x in vals]}) as resp:
-            pass
+def _encode_cursor(rec: asyncpg.Record) -> str:
+    raw = json.dumps([rec['time'].isoformat(), rec['key'], rec['node']]).encode()
+    return base64.urlsafe_b64encode(raw).decode()
 
-    await session.close()
-    return web.Response()
+def _decode_cursor(cursor: str) -> tuple:
+    time, key, node = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return datetime.datetime.fromisoformat(time), str(key), int(node)
+
+async def _list_uploads(request: app.TypedRequest, conn: asyncpg.Connection, query: str, args: list,
+                        row: Callable[[asyncpg.Record], dict], group: Callable[[List[asyncpg.Record]], Any]):
+    """
+    Pages through uploads in (time, key, node) order, starting after the ``after`` cursor.
+    By default a page of up to ``limit`` uploads is returned, and the cursor of the next page is sent in the
+    X-Next-Cursor header. With ``format=ndjson``, every remaining upload is streamed from a database cursor, one per line.
+    """
+    try:
+        after = _decode_cursor(request.query['after']) if "after" in request.query else None
+        limit = int(request.query.get("limit", LIST_PAGE_SIZE))
+    except (ValueError, TypeError):
+        return web.Response(status=400, reason="Invalid cursor or limit")
+
+    if not 1 <= limit <= LIST_MAX_PAGE_SIZE:
+        return web.Response(status=400, reason=f"limit must be between 1 and {LIST_MAX_PAGE_SIZE}")
+
+    if after is not None:
+        args = [*args, *after]
+        query += f" AND (uploads.time, uploads.key, uploads.node) > (${len(args) - 2}, ${len(args) - 1}, ${len(args)})"
+
+    query += " ORDER BY uploads.time, uploads.key, uploads.node"
+
+    if request.query.get("format") == "ndjson":
+        if "limit" in request.query:
+            args = [*args, limit]
+            query += f" LIMIT ${len(args)}"
+
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        buffer = bytearray()
+        async with conn.transaction():
+            async for rec in conn.cursor(query, *args, prefetch=500):
+                buffer += json.dumps({**row(rec), "cursor": _encode_cursor(rec)}).encode() + b"\n"
+                if len(buffer) >= LIST_WRITE_SIZE:
+                    await response.write(bytes(buffer))
+                    buffer.clear()
+
+        await response.write(bytes(buffer))
+        await response.write_eof()
+        return response
+
+    values = await conn.fetch(query + f" LIMIT ${len(args) + 1}", *args, limit + 1)
+    headers = {}
+    if len(values) > limit:
+        values = values[:limit]
+        headers["X-Next-Cursor"] = _encode_cursor(values[-1])
+
+    return web.json_response(group(values), headers=headers)
 
 @router.get("/api/cdn/list")
 @handler.ratelimit(15, 60, "cdn.manage")
@@ -305,7 +498,7 @@ async def get_cdn_list(request: app.TypedRequest, conn: asyncpg.Connection):
 
     query = """
     SELECT
-        key, uploads.node, slaves.name, username
+        key, uploads.node, slaves.name, username, uploads.time
     FROM uploads
     INNER JOIN slaves
         ON slaves.node = uploads.node
@@ -316,30 +509,18 @@ async def get_cdn_list(request: app.TypedRequest, conn: asyncpg.Connection):
         vals.append(node)
         query += "AND uploads.node = (SELECT slaves.node FROM slaves WHERE slaves.name = $1)"
 
-    values = await conn.fetch(query, *vals)
-    resp = {}
-    if sort == "user":
-        for rec in values:
-            if rec['username'] in resp:
-                resp[rec['username']].append({"key": rec['key'], "node_id": rec['node'], "node": rec['name']})
-            else:
-                resp[rec['username']] = [{"key": rec['key'], "node_id": rec['node'], "node": rec['name']}]
+    def row(rec: asyncpg.Record) -> dict:
+        return {"key": rec['key'], "node_id": rec['node'], "node": rec['name'], "username": rec['username']}
 
-    elif sort == "node":
+    def group(values: List[asyncpg.Record]) -> dict:
+        field = {"user": "username", "node": "node", "nodename": "name"}[sort]
+        resp = {}
         for rec in values:
-            if rec['node'] in resp:
-                resp[rec['node']].append({"key": rec['key'], "node_id": rec['node'], "node": rec['name']})
-            else:
-                resp[rec['node']] = [{"key": rec['key'], "node_id": rec['node'], "node": rec['name']}]
+            resp.setdefault(rec[field], []).append({"key": rec['key'], "node_id": rec['node'], "node": rec['name']})
 
-    elif sort == "nodename":
-        for rec in values:
-            if rec['name'] in resp:
-                resp[rec['name']].append({"key": rec['key'], "node_id": rec['node'], "node": rec['name']})
-            else:
-                resp[rec['name']] = [{"key": rec['key'], "node_id": rec['node'], "node": rec['name']}]
+        return resp
 
-    return web.json_response(resp)
+    return await _list_uploads(request, conn, query, vals, row, group)
 
 @router.get("/api/cdn/list/{user}")
 @handler.ratelimit(15, 60, "cdn.manage")
@@ -353,8 +534,17 @@ async def get_cdn_list(request: app.TypedRequest, conn: asyncpg.Connection):
     if usr != auth and "cdn.manage" not in perms:
         return web.Response(reason="401 Unauthorized", status=401)
 
-    values = await conn.fetch("SELECT key, node, size FROM uploads WHERE username = $1 AND deleted is false ORDER BY time;", usr)
-    return web.json_response([{"key": rec['key'], "node": rec['node'], "size": rec['size']} for rec in values])
+    def row(rec: asyncpg.Record) -> dict:
+        return {"key": rec['key'], "node": rec['node'], "size": rec['size']}
+
+    return await _list_uploads(
+        request,
+        conn,
+        "SELECT key, node, size, time FROM uploads WHERE username = $1 AND deleted is false",
+        [usr],
+        row,
+        lambda values: [row(rec) for rec in values]
+    )
 
 @router.get("/api/cdn/user")
 @handler.ratelimit(15, 60, "cdn.manage")
@@ -368,12 +558,16 @@ async def get_user_stats(request: app.TypedRequest, conn: asyncpg.Connection):
     if usr != auth and "cdn.manage" not in perms:
         return web.Response(reason="401 Unauthorized", status=401)
 
-    amount = await conn.fetchval("SELECT COUNT(*) FROM uploads WHERE username = $1 and deleted is false", usr)
-    recent = await conn.fetchrow("SELECT key, slaves.name FROM uploads INNER JOIN slaves ON slaves.node = uploads.node WHERE username = $1 and deleted is false ORDER BY time DESC LIMIT 1", usr)
+    amount = request.app.cdn_stats.users.get(usr, 0)
+    recent = request.app.cdn_stats.user_last_upload(usr)
+    if recent is None and amount:
+        # the cached one was deleted, this is served by uploads_user_list_idx
+        recent = await conn.fetchrow("SELECT slaves.name, key FROM uploads INNER JOIN slaves ON slaves.node = uploads.node WHERE username = $1 and deleted is false ORDER BY time DESC LIMIT 1", usr)
+
     if not amount and not recent:
         return web.Response(status=400, reason="User not found/no entries")
 
     return web.json_response({
         "upload_count": amount,
-        "last_upload": f"https://{request.app.settings['child_site']}/{recent['name']}/{recent['key']}"
+        "last_upload": recent and f"https://{request.app.settings['child_site']}/{recent[0]}/{recent[1]}"
     })
@@ -1,3 +1,4 @@
+import asyncio
 import time
 import traceback
 import logging
@@ -5,6 +6,7 @@ import logging
 import asyncpg
 from aiohttp import web
 from utils import handler, app
+from utils.cdn import events, nodes
 
 router = web.RouteTableDef()
 
@@ -30,6 +32,8 @@ async def post_node(request: app.TypedRequest, conn: asyncpg.Connection):
         print(e)
         return web.Response(status=400, text="Bad json")
 
+    metrics = nodes.parse_metrics(data)
+
     node = data.get("node", None)
     if node is not None:
         try:
@@ -43,7 +47,7 @@ async def post_node(request: app.TypedRequest, conn: asyncpg.Connection):
         if not new:
             d = await conn.fetchrow("SELECT node, name FROM slaves WHERE ip = $1 and port = $2", ip, port)
             if d:
-                request.app.slaves[d['node']] = {"ip": ip, "port": port, "name": d['name'], "id": d['node'], "signin": time.time()}
+                request.app.cdn_nodes.heartbeat(d['node'], d['name'], ip, port, metrics)
                 return web.json_response({"node": d['node'], "port": port, "ip": ip, "name": d['name']}, status=200)
         try:
             if name is not None:
@@ -72,7 +76,7 @@ async def post_node(request: app.TypedRequest, conn: asyncpg.Connection):
                 except asyncpg.UniqueViolationError:
                     return web.Response(status=400, text="Node Exists.")
 
-            request.app.slaves[d['node']] = {"ip": ip, "port": port, "name": d['name'], "id": d['node'], "signin": time.time()}
+            request.app.cdn_nodes.heartbeat(d['node'], d['name'], ip, port, metrics)
             return web.json_response({"node": d['node'], "port": port, "name": d['name'], "ip": ip}, status=201) # we've made a new slave
         except Exception as e:
             logger.error(f"error while making new node {name=} {ip=} {port=}", exc_info=e)
@@ -84,7 +88,7 @@ async def post_node(request: app.TypedRequest, conn: asyncpg.Connection):
         if not data:
             return web.Response(status=400, text="Node mismatch")
 
-        request.app.slaves[data['node']] = {"ip": ip, "port": port, "name": data['name'], "id": data['node'], "signin": time.time()}
+        request.app.cdn_nodes.heartbeat(data['node'], data['name'], ip, port, metrics)
         return web.json_response({"node": data['node'], "port": port, "name": data['name'], "ip": ip})
 
 @router.get("/api/cdn/nodes")
@@ -98,7 +102,36 @@ async def get_nodes(request: app.TypedRequest, conn: asyncpg.Connection):
     else:
         slaves = {i: n.copy() for i, n in slaves.items()}
 
+    inflight = request.app.cdn_uploads.inflight
     for x in slaves.values():
-        x['signin'] = time.time() - x['signin']
+        x['signin'] = x['signin'] and time.time() - x['signin']
+        x['inflight'] = inflight.get(x['id'], 0)
+        x['load'] = nodes.load_score(x, x['inflight'])
 
     return web.json_response(slaves)
+
+@router.post("/api/cdn/nodes/events")
+@handler.ratelimit(0, 0, ignore_logging=True)
+async def post_node_events(request: app.TypedRequest, conn: asyncpg.Connection):
+    if request.headers.get("Authorization") != request.app.settings['slave_key']:
+        return web.Response(status=401, text="Unauthorized")
+
+    try:
+        node = int(request.query['node'])
+    except (KeyError, ValueError):
+        return web.Response(status=400, text="Missing or invalid node")
+
+    if node not in request.app.slaves:
+        return web.Response(status=400, text="Unknown node")
+
+    # gzip/deflate bodies are decompressed as they're read, so the cap applies to the decompressed size
+    max_size = request.app.settings.get("cdn_event_batch_size", 8 * 1024 * 1024)
+    body = bytearray()
+    async for chunk in request.content.iter_any():
+        body += chunk
+        if len(body) > max_size:
+            return web.Response(status=413, text="Batch is too large")
+
+    records, views, rejected = await asyncio.get_running_loop().run_in_executor(None, events.parse_events, bytes(body), node)
+    await events.ingest(conn, node, records, views)
+    return web.json_response({"accepted": len(records), "rejected": rejected})
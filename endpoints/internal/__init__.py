@@ -1,5 +1,6 @@
-from . import authorizations, permissions
+from . import authorizations, permissions, stats
 
 def setup(app):
     app.add_routes(authorizations.router)
-    app.add_routes(permissions.router)
\ No newline at end of file
+    app.add_routes(permissions.router)
+    app.add_routes(stats.router)
\ No newline at end of file
@@ -1,4 +1,6 @@
+import base64
 import datetime
+import json
 import secrets
 
 import asyncpg
@@ -289,22 +291,78 @@ async def create_ban(request: app.TypedRequest, conn: asyncpg.Connection):
     await conn.fetchrow("INSERT INTO bans (ip, user_agent, reason) VALUES ($1, $2, $3) ON CONFLICT DO NOTHING", ip, useragent, reason)
     return web.Response(status=201)
 
+LOG_PAGE_SIZE = 50
+
+def _encode_log_cursor(row: asyncpg.Record) -> str:
+    return base64.urlsafe_b64encode(json.dumps([row['accessed'].isoformat(), row['id']]).encode()).decode()
+
+def _parse_timestamp(value: str) -> datetime.datetime:
+    # logs.accessed is a naive utc timestamp, and asyncpg refuses to compare it with an aware datetime
+    when = datetime.datetime.fromisoformat(value)
+    if when.tzinfo is not None:
+        when = when.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    return when
+
+def _decode_log_cursor(cursor: str) -> tuple:
+    accessed, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return _parse_timestamp(accessed), int(id)
+
 @router.get("/api/internal/logs")
 @handler.ratelimit(0, 0)
 async def get_logs(request: app.TypedRequest, conn: asyncpg.Connection):
-    try:
-        page = int(request.query.get("page", "0"))
-    except:
-        return web.Response(reason="page must be a number", status=400)
-
     oldest_first = request.query.get("oldest-first", "").lower() == "true"
     safe = request.query.get("safe", "").lower() == "true"
 
-    data = await conn.fetch(f"SELECT endpoint, remote, authorized_user, response_code, accessed, user_agent "
-                            f"FROM logs ORDER BY accessed {'ASC' if oldest_first else 'DESC'} OFFSET $1 LIMIT 50;",
-                            page*50)
+    if "page" in request.query: # offset paging was replaced, fail loudly rather than return the first page forever
+        return web.Response(
+            reason="The page parameter is no longer supported, pass the cursor from the previous response instead",
+            status=400
+        )
+
+    clauses = []
+    args = []
+    try:
+        if "cursor" in request.query:
+            args.extend(_decode_log_cursor(request.query['cursor']))
+            clauses.append(f"(accessed, id) {'>' if oldest_first else '<'} ($1, $2)")
+
+        # a time range lets postgres skip whole partitions
+        if "since" in request.query:
+            args.append(_parse_timestamp(request.query['since']))
+            clauses.append(f"accessed >= ${len(args)}")
+
+        if "until" in request.query:
+            args.append(_parse_timestamp(request.query['until']))
+            clauses.append(f"accessed < ${len(args)}")
+
+        if "status" in request.query:
+            status = request.query['status'].lower()
+            if status.endswith("xx"):
+                args.extend((int(status[0]) * 100, int(status[0]) * 100 + 100))
+                clauses.append(f"response_code >= ${len(args) - 1} AND response_code < ${len(args)}")
+            else:
+                args.append(int(status))
+                clauses.append(f"response_code = ${len(args)}")
+    except (ValueError, TypeError):
+        return web.Response(reason="Invalid cursor, since, until or status", status=400)
+
+    if "endpoint" in request.query:
+        args.append(request.query['endpoint'])
+        clauses.append(f"endpoint = ${len(args)}")
+
+    if "user" in request.query:
+        args.append(request.query['user'])
+        clauses.append(f"authorized_user = ${len(args)}")
+
+    order = "ASC" if oldest_first else "DESC"
+    data = await conn.fetch(f"SELECT endpoint, remote, authorized_user, response_code, accessed, user_agent, id "
+                            f"FROM logs {'WHERE ' + ' AND '.join(clauses) if clauses else ''} "
+                            f"ORDER BY accessed {order}, id {order} LIMIT {LOG_PAGE_SIZE};",
+                            *args)
     def hook(row):
         d = dict(row)
+        del d['id']
         if safe:
             del d['remote']
 
@@ -313,4 +371,7 @@ async def get_logs(request: app.TypedRequest, conn: asyncpg.Connection):
                 d[a] = b.isoformat()
         return d
 
-    return web.json_response({"rows": [hook(x) for x in data]})
\ No newline at end of file
+    return web.json_response({
+        "rows": [hook(x) for x in data],
+        "cursor": _encode_log_cursor(data[-1]) if len(data) == LOG_PAGE_SIZE else None
+    })
\ No newline at end of file
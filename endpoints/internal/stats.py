@@ -0,0 +1,34 @@
+import datetime
+
+import asyncpg
+from aiohttp import web
+
+from utils import handler, app
+
+router = web.RouteTableDef()
+
+@router.get("/api/internal/ocr")
+@handler.ratelimit(0, 0)
+async def get_ocr_stats(request: app.TypedRequest, conn: asyncpg.Connection):
+    return web.json_response({**request.app.ocr.stats(), "cache": request.app.ocr_cache.stats()})
+
+@router.get("/api/internal/cdn")
+@handler.ratelimit(0, 0)
+async def get_cdn_internal_stats(request: app.TypedRequest, conn: asyncpg.Connection):
+    return web.json_response({"uploads": request.app.cdn_uploads.stats(), "expiry": request.app.cdn_expiry.stats()})
+
+@router.get("/api/internal/analytics")
+@handler.ratelimit(0, 0)
+async def get_analytics(request: app.TypedRequest, conn: asyncpg.Connection):
+    resolution = request.query.get("resolution", "minute")
+    if resolution not in ("minute", "hour"):
+        return web.Response(reason="resolution must be one of minute, hour", status=400)
+
+    try:
+        window = int(request.query.get("window", 60 if resolution == "minute" else 24))
+        top = min(int(request.query.get("top", 10)), 100)
+    except ValueError:
+        return web.Response(reason="window and top must be numbers", status=400)
+
+    since = datetime.datetime.utcnow() - (datetime.timedelta(minutes=window) if resolution == "minute" else datetime.timedelta(hours=window))
+    return web.json_response(request.app.rollups.query(resolution, since, top))
@@ -1,20 +1,23 @@
-import pathlib
-import time
-import uuid
+import asyncio
+import json
 import os
-import subprocess
+import time
 import re
 
+import aiohttp
 import asyncpg
 import mathparser
+import yarl
 from aiohttp import web
 
 import utils.rtfm
+import utils.rtfs
 from utils.handler import ratelimit
 from utils import ocr, app
 from ..cdn.cdn import upload_media_to_slaves
 
 DOCRS_RE = re.compile(r"https://docs\.rs/([^/]*)")
+OCR_CHUNK_SIZE = 64 * 1024
 router = web.RouteTableDef()
 
 @router.get("/api/public/rtfs")
@@ -43,8 +46,10 @@ async def do_rtfs(request: app.TypedRequest, _: asyncpg.Connection):
             return web.Response(status=400, reason="library not found. If you think it should be added, contact IAmTomahawkx#1000 on discord.")
         else:
             return v
+    except utils.rtfs.BuildFailed as e:
+        return web.Response(status=503, reason=str(e), headers={"Retry-After": str(e.retry_after)})
     except RuntimeError:
-        return web.Response(status=500, reason="Source index is not complete, try again later")
+        return web.Response(status=503, reason="Source index is not complete, try again later", headers={"Retry-After": "30"})
 
 @router.get("/api/public/rtfm")
 @router.get("/api/public/rtfm.sphinx")
@@ -89,18 +94,23 @@ async def do_rtfm_rs(request: app.TypedRequest, _: asyncpg.Connection):
                                                "(https://discord.gg/Bf5jMRKtD3) for an explanation on this")
 
 @router.get("/api/public/ocr")
-@ratelimit(2, 10)
-async def do_ocr(request: app.TypedRequest, _: asyncpg.Connection):
+@ratelimit(2, 10, hold_connection=False)
+async def do_ocr(request: app.TypedRequest, conn: asyncpg.Pool):
     ext = request.query.get("filetype", None)
     if ext is None:
         return web.Response(reason="File-Type query arg is required.", status=400)
 
+    try:
+        request.app.ocr.check_capacity() # don't read a whole upload just to turn it away
+    except ocr.QueueFull as e:
+        return web.Response(status=503, reason="The OCR queue is full, try again later", headers={"Retry-After": str(e.retry_after)})
+
     try:
         reader = await request.multipart()
         _data = await reader.next()
         async def data():
             while True:
-                v = await _data.read_chunk()
+                v = await _data.read_chunk(OCR_CHUNK_SIZE)
                 if not v:
                     break
                 yield v
@@ -108,7 +118,7 @@ async def do_ocr(request: app.TypedRequest, _: asyncpg.Connection):
     except AssertionError:
         async def data():
             while True:
-                v = await request.content.read(32)
+                v = await request.content.read(OCR_CHUNK_SIZE)
                 if not v:
                     break
 
@@ -116,22 +126,138 @@ async def do_ocr(request: app.TypedRequest, _: asyncpg.Connection):
     except:
         return web.Response(reason="Invalid multipart request", status=400)
 
-    name = ('%032x' % uuid.uuid4().int)[:8] + "." + ext
-    pth = pathlib.Path(f"../tmp/{name}")
-    buffer = pth.open("wb")
+    hasher = request.app.ocr_cache.hasher()
     try:
-        async for chunk in data():
-            buffer.write(chunk)
-    except:
-        pass
-
-    buffer.close()
+        image = await ocr.buffer_image(
+            data(),
+            request.app.settings.get("ocr_max_size", 10 * 1024 * 1024),
+            request.app.settings.get("ocr_spill_size", 4 * 1024 * 1024),
+            hasher
+        )
+    except ocr.ImageTooLarge:
+        return web.Response(reason="Image is too large", status=413)
+    except ocr.InvalidImage:
+        return web.Response(reason="Could not read the uploaded image", status=400)
+
+    key = hasher.hexdigest()
+    user = (request.user and request.user['username']) or request.headers.get("X-Forwarded-For") or request.remote
+    try:
+        response = await ocr.do_cached_ocr(request.app.ocr, request.app.ocr_cache, user, image, key, conn)
+    except ocr.QueueFull as e:
+        return web.Response(status=503, reason="The OCR queue is full, try again later", headers={"Retry-After": str(e.retry_after)})
+    except RuntimeError: # the worker couldn't decode the image, eg. a truncated upload
+        return web.Response(reason="Failed to process the image", status=400)
+    finally:
+        if isinstance(image, str):
+            os.remove(image)
 
-    response = await ocr.do_ocr(pth, request.app.loop)
-    os.remove(pth)
     return web.json_response({"data": response})
 
 
+def _cleanup_images(images: list):
+    for image in images:
+        if isinstance(image, tuple) and isinstance(image[0], str): # spilled to disk
+            os.remove(image[0])
+
+@router.post("/api/public/ocr.batch")
+@ratelimit(1, 10, hold_connection=False)
+async def do_ocr_batch(request: app.TypedRequest, _: asyncpg.Pool):
+    try:
+        request.app.ocr.check_capacity()
+    except ocr.QueueFull as e:
+        return web.Response(status=503, reason="The OCR queue is full, try again later", headers={"Retry-After": str(e.retry_after)})
+
+    max_images = request.app.settings.get("ocr_batch_size", 8)
+    max_size = request.app.settings.get("ocr_max_size", 10 * 1024 * 1024)
+    spill_size = request.app.settings.get("ocr_spill_size", 4 * 1024 * 1024)
+    user = (request.user and request.user['username']) or request.headers.get("X-Forwarded-For") or request.remote
+
+    images = [] # (image, cache key) or an error string, in request order
+
+    async def read(chunks):
+        hasher = request.app.ocr_cache.hasher()
+        try:
+            image = await ocr.buffer_image(chunks, max_size, spill_size, hasher)
+        except ocr.ImageTooLarge:
+            return "Image is too large"
+        except ocr.InvalidImage:
+            return "Could not read the image"
+
+        return image, hasher.hexdigest()
+
+    if "multipart" in request.content_type:
+        reader = await request.multipart()
+        while True:
+            part = await reader.next()
+            if part is None:
+                break
+
+            if len(images) == max_images:
+                _cleanup_images(images)
+                return web.Response(reason=f"A batch may contain at most {max_images} images", status=400)
+
+            async def chunks():
+                while True:
+                    v = await part.read_chunk(OCR_CHUNK_SIZE)
+                    if not v:
+                        break
+                    yield v
+
+            images.append(await read(chunks()))
+
+    else:
+        try:
+            urls = [yarl.URL(str(x)) for x in (await request.json())['urls']]
+        except:
+            return web.Response(reason="Expected a multipart body or a json payload with a 'urls' list", status=400)
+
+        if len(urls) > max_images:
+            return web.Response(reason=f"A batch may contain at most {max_images} images", status=400)
+
+        if any(url.host != request.app.settings['child_site'] for url in urls):
+            return web.Response(reason=f"Image urls must be hosted on {request.app.settings['child_site']}", status=400)
+
+        async def fetch(session: aiohttp.ClientSession, url: yarl.URL):
+            try:
+                async with session.get(url) as resp:
+                    if resp.status != 200:
+                        return f"Failed to fetch the image ({resp.status})"
+
+                    return await read(resp.content.iter_chunked(OCR_CHUNK_SIZE))
+            except aiohttp.ClientError:
+                return "Failed to fetch the image"
+
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
+            images = await asyncio.gather(*(fetch(session, url) for url in urls))
+
+    if not images:
+        return web.Response(reason="No images were given", status=400)
+
+    async def process(index: int, image):
+        if isinstance(image, str):
+            return {"index": index, "error": image}
+
+        try:
+            data = await ocr.do_cached_ocr(request.app.ocr, request.app.ocr_cache, user, image[0], image[1], request.app.db)
+        except ocr.QueueFull as e:
+            return {"index": index, "error": "The OCR queue is full", "retry_after": e.retry_after}
+        except RuntimeError:
+            return {"index": index, "error": "Failed to process the image"}
+
+        return {"index": index, "data": data}
+
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    try:
+        for fut in asyncio.as_completed([process(i, image) for i, image in enumerate(images)]):
+            await response.write(json.dumps(await fut).encode() + b"\n")
+    finally:
+        _cleanup_images(images)
+
+    await response.write_eof()
+    return response
+
+
 @router.get("/api/public/xkcd")
 @ratelimit(10, 10)
 async def xkcd(request: app.TypedRequest, conn: asyncpg.Connection):
@@ -139,7 +265,11 @@ async def xkcd(request: app.TypedRequest, conn: asyncpg.Connection):
     if not query:
         return web.Response(reason="Missing 'search' query parameter", status=400)
 
-    return await request.app.xkcd.search_xkcd(query, request)
+    mode = request.query.get("mode", "title")
+    if mode not in ("title", "fulltext"):
+        return web.Response(reason="mode must be one of 'title' or 'fulltext'", status=400)
+
+    return await request.app.xkcd.search_xkcd(query, request, mode == "fulltext")
 
 @router.put("/api/public/xkcd/tags")
 @ratelimit(1, 10)
@@ -156,14 +286,14 @@ async def put_xkcd_tag(request: app.TypedRequest, conn: asyncpg.Connection):
     except:
         return web.Response(reason="Bad JSON payload", status=400)
 
-    d = await conn.fetchval("SELECT num FROM xkcd WHERE $1 = ANY(extra_tags)", tag)
+    d = await conn.fetchval("SELECT num FROM xkcd WHERE extra_tags @> ARRAY[$1]::text[]", tag)
     if d:
         return web.Response(reason=f"Tag '{tag}' is already bound to xkcd #{d}")
 
     if not await conn.fetchval("UPDATE xkcd SET extra_tags = array_append(extra_tags, $1) WHERE num = $2 RETURNING num", tag, num):
         return web.Response(reason=f"comic #{num} does not exist", status=400)
 
-    request.app.xkcd._cache.clear()
+    request.app.xkcd.add_tag(num, tag)
     return web.Response(status=204)
 
 @router.post("/api/public/math")
@@ -208,7 +338,7 @@ async def math(request: app.TypedRequest, conn: asyncpg.Connection):
 
     imgs = []
     if images:
-        node = list(filter(lambda x: x['name'] == "math", request.app.slaves.values()))
+        node = [x for x in request.app.cdn_nodes.upload_nodes() if x['name'] == "math"]
         if node:
             node = node[0]
             for img in images:
@@ -241,26 +371,77 @@ async def reload_rtfs(request: app.TypedRequest, _) -> web.Response:
     if not admin and "public.rtfs.reload" not in perms:
         return web.Response(reason="You need the public.rtfs.reload permission to use this endpoint", status=401)
 
-    dirs = os.listdir("repos")
-    success = []
-    fail = []
-    from utils.rtfs import Indexes
+    job = request.app.rtfs.reload()
+    return web.json_response({"job": job, "status": f"/api/public/rtfs.reload/{job}"}, status=202)
 
-    indexer = Indexes()
+@router.get("/api/public/rtfs.reload/{job}")
+@ratelimit(0, 0, "public.rtfs.reload")
+async def reload_rtfs_status(request: app.TypedRequest, _) -> web.Response:
+    if not request.user: # the path has a parameter, so no routes row ever matches it
+        return web.Response(reason="401 Unauthorized", status=401)
 
-    for d in dirs:
-        try:
-            subprocess.run(["/bin/bash", "-c", f"cd repos/{d} && git pull"])
-        except:
-            fail.append(d)
-        else:
-            success.append(d)
+    perms, admin = request.user['permissions'], "administrator" in request.user['permissions']
 
-    await indexer._do_index()
-    request.app.rtfs = indexer
+    if not admin and "public.rtfs.reload" not in perms:
+        return web.Response(reason="You need the public.rtfs.reload permission to use this endpoint", status=401)
 
-    return web.json_response({
-        "success": success,
-        "fail": fail,
-        "commits": {name: value.commit for name, value in indexer.index.items()}
-    })
\ No newline at end of file
+    job = request.app.rtfs.get_job(request.match_info['job'])
+    if job is None:
+        return web.Response(reason="Job not found", status=404)
+
+    return web.json_response(job)
+
+@router.post("/api/public/rtfs.libraries")
+@ratelimit(0, 0, "public.rtfs.reload")
+async def add_rtfs_library(request: app.TypedRequest, conn: asyncpg.Connection) -> web.Response:
+    if not request.user:
+        return web.Response(reason="401 Unauthorized", status=401)
+
+    perms, admin = request.user['permissions'], "administrator" in request.user['permissions']
+
+    if not admin and "public.rtfs.reload" not in perms:
+        return web.Response(reason="You need the public.rtfs.reload permission to use this endpoint", status=401)
+
+    try:
+        data = await request.json()
+        name = str(data['name']).lower()
+        repo_url = str(data['url'])
+        index_folder = str(data['folder'])
+    except KeyError as e:
+        return web.Response(reason=f"Missing '{e.args[0]}' key from json payload", status=400)
+    except:
+        return web.Response(reason="Bad JSON payload", status=400)
+
+    try:
+        await request.app.rtfs.add_library(
+            conn,
+            name,
+            repo_url,
+            index_folder,
+            repo_path=data.get("path") and str(data['path']),
+            branch=data.get("branch") and str(data['branch']),
+            version=data.get("version")
+        )
+    except ValueError as e:
+        return web.Response(reason=str(e), status=400)
+    return web.Response(status=201)
+
+@router.delete("/api/public/rtfs.libraries")
+@ratelimit(0, 0, "public.rtfs.reload")
+async def remove_rtfs_library(request: app.TypedRequest, conn: asyncpg.Connection) -> web.Response:
+    if not request.user:
+        return web.Response(reason="401 Unauthorized", status=401)
+
+    perms, admin = request.user['permissions'], "administrator" in request.user['permissions']
+
+    if not admin and "public.rtfs.reload" not in perms:
+        return web.Response(reason="You need the public.rtfs.reload permission to use this endpoint", status=401)
+
+    name = request.query.get("name", "").lower()
+    if not name:
+        return web.Response(reason="Missing name parameter", status=400)
+
+    if not await request.app.rtfs.remove_library(conn, name):
+        return web.Response(reason="library not found", status=404)
+
+    return web.Response(status=204)
@@ -5,7 +5,6 @@ import aiohttp_jinja2
 import jinja2
 import os
 import sys
-import subprocess
 import markdown2
 import setproctitle
 import logging
@@ -32,16 +31,6 @@ handle = logging.StreamHandler(sys.stderr)
 handle.setFormatter(logging.Formatter("{levelname}[{name}] : {message}", style="{"))
 logger.addHandler(handle)
 
-try:
-    logger.warning("Pulling rtfs repos")
-    dirs = os.listdir("repos")
-    for d in dirs:
-        subprocess.run(["/bin/bash", "-c", f"cd repos/{d} && git pull"])
-except:
-    logger.warning("Failed to pull repos")
-else:
-    logger.warning("Pulled repos")
-
 try:
     import uvloop
     uvloop.install()
@@ -1,34 +1,31 @@
 import asyncio
 import asyncpg
-import os
 import json
+import sys
+
+from utils import migrations
 
 async def main():
     with open("config.json") as f:
         cfg = json.load(f)
     conn = await asyncpg.connect(cfg['db']) # type: asyncpg.Connection
-    betaconn = await asyncpg.connect(cfg['db']+"_beta")
-    async with conn.transaction() as trans:
-        beta_routes = await betaconn.fetch("SELECT * FROM routes;")
-        await conn.executemany("INSERT INTO routes VALUES ($1, $2, $3) ON CONFLICT DO NOTHING", [[x['route'], x['method'], x['permission']] for x in beta_routes])
-
-        users = await conn.fetch("select * from auths;")
-        _updates = []
-        for user in users:
-            new_perms = []
-            perms = user['permissions']
-            if user['administrator']:
-                new_perms.append("administrator")
+    try:
+        if "--check" in sys.argv:
+            failures = await migrations.check_plans(conn)
+            for name, plan in failures:
+                print(f"{name} does not use an index:\n{plan}\n")
 
-            if "cdn" in perms:
-                perms.remove("cdn")
-                new_perms.append("cdn.upload")
+            print(f"{len(migrations.HOT_QUERIES) - len(failures)}/{len(migrations.HOT_QUERIES)} hot queries use an index")
+            return 1 if failures else 0
 
-            new_perms += perms
-            _updates.append([user['username'], new_perms])
+        ran = await migrations.migrate(conn)
+        for name in ran:
+            print(f"applied {name}")
 
-        await conn.execute("ALTER TABLE auths DROP COLUMN administrator;")
-        await conn.executemany("UPDATE auths SET permissions = $2 WHERE username = $1", _updates)
+        print(f"{len(ran)} migrations applied")
+        return 0
+    finally:
+        await conn.close()
 
 
-asyncio.run(main())
\ No newline at end of file
+sys.exit(asyncio.run(main()))
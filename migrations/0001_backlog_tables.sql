@@ -0,0 +1,43 @@
+-- tables and indexes added to schema.sql for rtfs, ocr and the cdn upload pipeline
+create table if not exists rtfs_libraries (
+    name text primary key,
+    repo_path text not null,
+    index_folder text not null,
+    repo_url text not null,
+    branch text,
+    version text
+);
+insert into rtfs_libraries values
+    ('discord.py-2', 'repos/discord.py-2', 'discord', 'https://github.com/Rapptz/discord.py/', null, null),
+    ('discord.py', 'repos/discord.py', 'discord', 'https://github.com/Rapptz/discord.py/', null, null),
+    ('twitchio', 'repos/TwitchIO', 'twitchio', 'https://github.com/TwitchIO/TwitchIO/', null, null),
+    ('wavelink', 'repos/Wavelink', 'wavelink', 'https://github.com/PythonistaGuild/Wavelink/', null, null),
+    ('aiohttp', 'repos/aiohttp', 'aiohttp', 'https://github.com/aio-libs/aiohttp/', null, null),
+    ('enhanced-discord.py', 'repos/enhanced-discord.py', 'discord', 'https://github.com/Idevision/Enhanced-discord.py', '2.0', null)
+on conflict do nothing;
+create table if not exists ocr_cache (
+    hash text primary key,
+    result text not null,
+    created timestamp not null default (now() at time zone 'utc')
+);
+create table if not exists upload_replicas
+(
+    key         text not null,
+    node        integer not null,
+    replica     integer not null references slaves (node),
+    replica_key text not null,
+    PRIMARY KEY (key, node, replica),
+    FOREIGN KEY (key, node) REFERENCES uploads (key, node) ON DELETE CASCADE
+);
+create table if not exists cdn_dead_letters
+(
+    key      text not null,
+    node     integer not null references slaves (node),
+    reason   text,
+    attempts integer not null default 1,
+    failed   timestamp not null default (now() at time zone 'utc'),
+    PRIMARY KEY (key, node)
+);
+create index if not exists uploads_expiry_idx on uploads (expiry) where expiry is not null and deleted is false;
+create index if not exists uploads_list_idx on uploads (time, key, node) where deleted is false;
+create index if not exists uploads_user_list_idx on uploads (username, time, key, node) where deleted is false;
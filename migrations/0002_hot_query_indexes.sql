@@ -0,0 +1,13 @@
+-- token lookups on every authorized request
+create index if not exists auths_auth_key_idx on auths (auth_key) where auth_key is not null;
+-- rtfm cache reads, and the cascade when an rtfm entry expires
+create index if not exists rtfm_lookup_url_idx on rtfm_lookup (url);
+-- xkcd tag lookups, queried with extra_tags @> ARRAY[tag]
+create index if not exists xkcd_extra_tags_idx on xkcd using gin (extra_tags);
+-- the logs are append-only and roughly ordered by time, so a BRIN index stays tiny
+create index if not exists logs_accessed_idx on logs using brin (accessed);
+create index if not exists cdn_logs_accessed_idx on cdn_logs using brin (accessed);
+-- view counting and purges look replicas up by the node holding them
+create index if not exists upload_replicas_replica_idx on upload_replicas (replica, replica_key);
+-- the ban expiry sweep in the offline task
+create index if not exists bans_expires_idx on bans (expires) where expires is not null;
@@ -0,0 +1,56 @@
+-- logs and cdn_logs become partitioned by week on accessed, so old weeks can be dropped instead of deleted.
+-- logs also gets an id, so it can be paged through with a (accessed, id) cursor.
+alter table logs rename to logs_old;
+alter table cdn_logs rename to cdn_logs_old;
+
+create table logs
+(
+    remote text not null,
+    accessed timestamp not null,
+    user_agent text not null,
+    endpoint text not null,
+    authorized_user text,
+    response_code integer not null,
+    id bigserial not null
+) partition by range (accessed);
+create table logs_default partition of logs default;
+
+create table cdn_logs (
+    image text not null,
+    node integer not null,
+    restricted boolean not null,
+    remote text not null,
+    accessed timestamp not null,
+    user_agent text not null,
+    authorized_user text,
+    response_code integer not null
+) partition by range (accessed);
+create table cdn_logs_default partition of cdn_logs default;
+
+do $$
+declare
+    tbl text;
+    week timestamp;
+begin
+    foreach tbl in array array['logs', 'cdn_logs'] loop
+        execute format('select date_trunc(''week'', coalesce(min(accessed), now() at time zone ''utc'')) from %I', tbl || '_old') into week;
+        while week < date_trunc('week', now() at time zone 'utc') + interval '2 weeks' loop
+            execute format(
+                'create table %I partition of %I for values from (%L) to (%L)',
+                tbl || '_p' || to_char(week, 'YYYYMMDD'), tbl, week, week + interval '1 week'
+            );
+            week := week + interval '1 week';
+        end loop;
+    end loop;
+end $$;
+
+insert into logs (remote, accessed, user_agent, endpoint, authorized_user, response_code)
+    select remote, accessed, user_agent, endpoint, authorized_user, response_code from logs_old order by accessed;
+insert into cdn_logs select * from cdn_logs_old;
+drop table logs_old;
+drop table cdn_logs_old;
+
+create index logs_accessed_idx on logs (accessed, id);
+create index logs_endpoint_idx on logs (endpoint, accessed);
+create index logs_user_idx on logs (authorized_user, accessed);
+create index cdn_logs_accessed_idx on cdn_logs using brin (accessed);
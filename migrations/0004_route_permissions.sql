@@ -0,0 +1,9 @@
+-- permission rows for routes added after the routes table was seeded. route_permissions is loaded at startup.
+insert into permissions values ('internal.stats') on conflict do nothing;
+insert into permissions values ('public.ocr') on conflict do nothing;
+insert into routes values
+    ('/api/internal/analytics', 'GET', 'internal.stats'),
+    ('/api/public/ocr.batch', 'POST', 'public.ocr'),
+    ('/api/internal/ocr', 'GET', 'internal.stats'),
+    ('/api/internal/cdn', 'GET', 'internal.stats')
+on conflict (route, method) do update set permission = excluded.permission;
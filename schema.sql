@@ -15,6 +15,7 @@ create table auths
     discord_id     bigint,
     ignores_ratelimits boolean not null default false
 );
+create index auths_auth_key_idx on auths (auth_key) where auth_key is not null;
 create table permissions
 (
     name text primary key
@@ -40,6 +41,28 @@ create table uploads
     expiry timestamp without time zone,
     PRIMARY KEY(key, node)
 );
+create table upload_replicas
+(
+    key         text not null,
+    node        integer not null,
+    replica     integer not null references slaves (node),
+    replica_key text not null,
+    PRIMARY KEY (key, node, replica),
+    FOREIGN KEY (key, node) REFERENCES uploads (key, node) ON DELETE CASCADE
+);
+create index upload_replicas_replica_idx on upload_replicas (replica, replica_key);
+create index uploads_expiry_idx on uploads (expiry) where expiry is not null and deleted is false;
+create index uploads_list_idx on uploads (time, key, node) where deleted is false;
+create index uploads_user_list_idx on uploads (username, time, key, node) where deleted is false;
+create table cdn_dead_letters
+(
+    key      text not null,
+    node     integer not null references slaves (node),
+    reason   text,
+    attempts integer not null default 1,
+    failed   timestamp not null default (now() at time zone 'utc'),
+    PRIMARY KEY (key, node)
+);
 create table applications (
     userid  bigint primary key,
     username text not null,
@@ -68,6 +91,7 @@ create table bans
     reason text,
     expires timestamp without time zone
 );
+create index bans_expires_idx on bans (expires) where expires is not null;
 create table logs
 (
     remote text not null,
@@ -75,8 +99,13 @@ create table logs
     user_agent text not null,
     endpoint text not null,
     authorized_user text,
-    response_code integer not null
-);
+    response_code integer not null,
+    id bigserial not null
+) partition by range (accessed);
+create table logs_default partition of logs default;
+create index logs_accessed_idx on logs (accessed, id);
+create index logs_endpoint_idx on logs (endpoint, accessed);
+create index logs_user_idx on logs (authorized_user, accessed);
 create table cdn_logs (
     image text not null,
     node integer not null,
@@ -86,7 +115,9 @@ create table cdn_logs (
     user_agent text not null,
     authorized_user text,
     response_code integer not null
-);
+) partition by range (accessed);
+create table cdn_logs_default partition of cdn_logs default;
+create index cdn_logs_accessed_idx on cdn_logs using brin (accessed);
 create table rtfm (
     url text primary key,
     expiry timestamp not null default ((now() at time zone 'utc') + INTERVAL '1 week'),
@@ -98,6 +129,7 @@ create table rtfm_lookup (
     value text not null,
     is_label boolean not null
 );
+create index rtfm_lookup_url_idx on rtfm_lookup (url);
 create table xkcd (
     num integer primary key,
     posted timestamp not null,
@@ -109,4 +141,34 @@ create table xkcd (
     image_url text not null,
     url text not null,
     extra_tags text[] not null default '{}'
-)
\ No newline at end of file
+);
+create index xkcd_extra_tags_idx on xkcd using gin (extra_tags);
+create table rtfs_libraries (
+    name text primary key,
+    repo_path text not null,
+    index_folder text not null,
+    repo_url text not null,
+    branch text,
+    version text
+);
+insert into rtfs_libraries values
+    ('discord.py-2', 'repos/discord.py-2', 'discord', 'https://github.com/Rapptz/discord.py/', null, null),
+    ('discord.py', 'repos/discord.py', 'discord', 'https://github.com/Rapptz/discord.py/', null, null),
+    ('twitchio', 'repos/TwitchIO', 'twitchio', 'https://github.com/TwitchIO/TwitchIO/', null, null),
+    ('wavelink', 'repos/Wavelink', 'wavelink', 'https://github.com/PythonistaGuild/Wavelink/', null, null),
+    ('aiohttp', 'repos/aiohttp', 'aiohttp', 'https://github.com/aio-libs/aiohttp/', null, null),
+    ('enhanced-discord.py', 'repos/enhanced-discord.py', 'discord', 'https://github.com/Idevision/Enhanced-discord.py', '2.0', null);
+create table ocr_cache (
+    hash text primary key,
+    result text not null,
+    created timestamp not null default (now() at time zone 'utc')
+);
+create table schema_migrations (
+    version integer primary key,
+    name text not null,
+    applied timestamp not null default (now() at time zone 'utc')
+);
+insert into schema_migrations (version, name) values
+    (1, 'backlog_tables'),
+    (2, 'hot_query_indexes'),
+    (3, 'partitioned_logs');
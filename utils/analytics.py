@@ -0,0 +1,114 @@
+import collections
+import datetime
+import random
+from typing import Dict, List, Optional
+
+class Rollup:
+    """
+    Aggregated traffic for one time bucket.
+    Latencies are kept as a fixed size random sample, and the top-N counters are trimmed to their most common keys
+    once they grow past ``max_keys``, so a bucket stays small no matter how much traffic it sees.
+    """
+    __slots__ = ("start", "requests", "statuses", "latencies", "endpoints", "users", "ips", "_seen")
+
+    SAMPLE_SIZE = 1024
+    MAX_KEYS = 5000
+
+    def __init__(self, start: datetime.datetime):
+        self.start = start
+        self.requests = 0
+        self.statuses: Dict[str, int] = collections.Counter()
+        self.latencies: List[float] = []
+        self.endpoints: Dict[str, int] = collections.Counter()
+        self.users: Dict[str, int] = collections.Counter()
+        self.ips: Dict[str, int] = collections.Counter()
+        self._seen = 0
+
+    def add(self, remote: str, user: Optional[str], endpoint: str, status: int, latency: float):
+        self.requests += 1
+        self.statuses[f"{status // 100}xx"] += 1
+
+        # reservoir sampling, so every request has the same chance to be in the sample
+        self._seen += 1
+        if len(self.latencies) < self.SAMPLE_SIZE:
+            self.latencies.append(latency)
+        else:
+            i = random.randrange(self._seen)
+            if i < self.SAMPLE_SIZE:
+                self.latencies[i] = latency
+
+        for counter, key in ((self.endpoints, endpoint), (self.users, user), (self.ips, remote)):
+            if key is None:
+                continue
+
+            counter[key] += 1
+            if len(counter) > self.MAX_KEYS:
+                for k, _ in counter.most_common()[self.MAX_KEYS // 2:]:
+                    del counter[k]
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+def summarize(rollups: List[Rollup], top: int = 10) -> dict:
+    statuses = collections.Counter()
+    endpoints = collections.Counter()
+    users = collections.Counter()
+    ips = collections.Counter()
+    latencies = []
+    for r in rollups:
+        statuses.update(r.statuses)
+        endpoints.update(r.endpoints)
+        users.update(r.users)
+        ips.update(r.ips)
+        latencies += r.latencies
+
+    return {
+        "requests": sum(r.requests for r in rollups),
+        "statuses": dict(statuses),
+        "latency_p50": percentile(latencies, 0.5),
+        "latency_p95": percentile(latencies, 0.95),
+        "top_endpoints": endpoints.most_common(top),
+        "top_users": users.most_common(top),
+        "top_ips": ips.most_common(top)
+    }
+
+class LogRollups:
+    """
+    Rolls the request log up into per-minute and per-hour buckets as requests are logged,
+    keeping the last ``minutes`` minute buckets and ``hours`` hour buckets.
+    """
+    def __init__(self, minutes: int = 120, hours: int = 48):
+        self.retention = {"minute": datetime.timedelta(minutes=minutes), "hour": datetime.timedelta(hours=hours)}
+        self._buckets: Dict[str, "collections.OrderedDict[datetime.datetime, Rollup]"] = {
+            "minute": collections.OrderedDict(),
+            "hour": collections.OrderedDict()
+        }
+
+    @staticmethod
+    def _floor(when: datetime.datetime, resolution: str) -> datetime.datetime:
+        when = when.replace(second=0, microsecond=0)
+        return when.replace(minute=0) if resolution == "hour" else when
+
+    def record(self, remote: str, user: Optional[str], endpoint: str, status: int, latency: float):
+        now = datetime.datetime.utcnow()
+        for resolution, buckets in self._buckets.items():
+            start = self._floor(now, resolution)
+            bucket = buckets.get(start)
+            if bucket is None:
+                bucket = buckets[start] = Rollup(start)
+                cutoff = now - self.retention[resolution]
+                while buckets and next(iter(buckets)) < cutoff:
+                    buckets.popitem(last=False)
+
+            bucket.add(remote, user, endpoint, status, latency)
+
+    def query(self, resolution: str, since: datetime.datetime, top: int = 10) -> dict:
+        rollups = [r for start, r in self._buckets[resolution].items() if start >= self._floor(since, resolution)]
+        return {
+            "summary": summarize(rollups, top),
+            "buckets": [{"start": r.start.isoformat(), **summarize([r], top)} for r in rollups]
+        }
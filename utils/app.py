@@ -1,6 +1,7 @@
 import sys
 import asyncio
 import json
+import logging
 import pathlib
 from typing import Callable, Optional, Tuple, Dict
 
@@ -10,14 +11,21 @@ from aiohttp import web
 from utils.rtfs import Indexes
 from utils.rtfm import DocReader, CargoReader
 from utils.xkcd import XKCD
+from utils.ocr import OCRScheduler, OCRCache
+from utils.cdn.upload import UploadPipeline
+from utils.cdn.nodes import NodeRegistry
+from utils.cdn.expiry import ExpirySweeper
+from utils.cdn.stats import CDNStats
+from utils.partitions import LogPartitions
+from utils.analytics import LogRollups
 
 test = "--unittest" in sys.argv
+logger = logging.getLogger("site.app")
 
 class App(web.Application):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs, middlewares=[shuttingdown_middleware])
         self._loop = asyncio.get_event_loop()
-        self.last_upload = None
         self.on_startup.append(self.async_init)
         self.test = test
         self._closing = False
@@ -53,8 +61,6 @@ class App(web.Application):
             for record in data:
                 self.route_permissions[(record['route'], record['method'])] = record['permission']
 
-        self._task = self._loop.create_task(self.offline_task())
-
         p = pathlib.Path("backup/defaults.json")
         if p.exists():
             with p.open() as f:
@@ -67,14 +73,75 @@ class App(web.Application):
                     "status": 503
                 }, msg)
 
-        self.rtfs = Indexes()
+        self.rtfs = Indexes(self)
         self.rtfm = DocReader(self)
         self.xkcd = XKCD(self)
         self.cargo_rtfm = CargoReader(self)
+        self.ocr = OCRScheduler(
+            self._loop,
+            workers=self.settings.get("ocr_workers", 2),
+            queue_size=self.settings.get("ocr_queue_size", 16),
+            per_user=self.settings.get("ocr_user_concurrency", 1),
+            preprocess=self.settings.get("ocr_preprocess")
+        )
+        self.ocr_cache = OCRCache(
+            size=self.settings.get("ocr_cache_size", 512),
+            use_db=self.settings.get("ocr_cache_db", False),
+            ttl=self.settings.get("ocr_cache_ttl", 60*60*24*7),
+            preprocess=self.settings.get("ocr_preprocess")
+        )
+
+        self.cdn_uploads = UploadPipeline(
+            self.settings['slave_key'],
+            max_size=self.settings.get("cdn_max_upload_size", 100 * 1024 * 1024),
+            timeout=self.settings.get("cdn_upload_timeout", 300),
+            idle_timeout=self.settings.get("cdn_upload_idle_timeout", 30)
+        )
+        self.cdn_nodes = NodeRegistry(
+            self,
+            interval=self.settings.get("cdn_probe_interval", 15),
+            threshold=self.settings.get("cdn_failure_threshold", 3),
+            cooldown=self.settings.get("cdn_failure_cooldown", 60)
+        )
+        await self.cdn_nodes.start()
+        self.slaves = self.cdn_nodes.nodes
+        self.cdn_expiry = ExpirySweeper(
+            self,
+            interval=self.settings.get("cdn_expiry_interval", 60),
+            batch_size=self.settings.get("cdn_expiry_batch_size", 500),
+            concurrency=self.settings.get("cdn_expiry_concurrency", 4)
+        )
+        self.cdn_expiry.start()
+        self.cdn_stats = CDNStats(self, interval=self.settings.get("cdn_stats_interval", 600))
+        await self.cdn_stats.start()
+
+        self.rollups = LogRollups(
+            minutes=self.settings.get("analytics_minutes", 120),
+            hours=self.settings.get("analytics_hours", 48)
+        )
+        self.log_partitions = LogPartitions(
+            self,
+            retention={
+                "logs": self.settings.get("log_retention_days", 90),
+                "cdn_logs": self.settings.get("cdn_log_retention_days", 90)
+            }
+        )
+        await self.log_partitions.start()
+
+        self._task = self._loop.create_task(self.offline_task())
 
     async def offline_task(self):
         while True:
-            await asyncio.shield(self.db.execute("DELETE FROM bans WHERE expires is not null and expires <= (now() at time zone 'utc')"), loop=self._loop)
+            try:
+                await asyncio.shield(self.db.execute("DELETE FROM bans WHERE expires is not null and expires <= (now() at time zone 'utc')"))
+            except Exception as e:
+                logger.error("Failed to clear expired bans", exc_info=e)
+
+            try:
+                await asyncio.shield(self.ocr_cache.purge_expired(self.db))
+            except Exception as e:
+                logger.error("Failed to purge the ocr cache", exc_info=e)
+
             await asyncio.sleep(120)
 
     def stop(self):
@@ -0,0 +1,67 @@
+import asyncio
+from typing import Dict, List, Optional, TYPE_CHECKING
+
+import aiohttp
+import yarl
+
+if TYPE_CHECKING:
+    from utils.cdn.nodes import NodeRegistry
+
+async def mass_delete(session: aiohttp.ClientSession, registry: "NodeRegistry", node_id: int, keys: List[str],
+                      retries: int = 3) -> Optional[str]:
+    """
+    Sends one mass-delete to a node, retrying with backoff. Returns None on success, or the last error.
+    ``session`` must carry the slave key.
+    """
+    error = None
+    for attempt in range(retries):
+        if attempt:
+            await asyncio.sleep(2 ** attempt)
+
+        node = registry.nodes.get(node_id)
+        if node is None:
+            return "unknown node"
+
+        if not registry.available(node):
+            error = "node unavailable"
+            continue
+
+        url = yarl.URL(f"http://{node['ip']}").with_port(node['port']).with_path("mass-delete")
+        try:
+            async with session.post(url, json={"ids": keys}) as resp:
+                if 200 <= resp.status < 300:
+                    registry.record_success(node)
+                    return None
+
+                error = f"{resp.status} {await resp.text()}"
+                if resp.status < 500: # the node understood and refused, retrying won't help
+                    return error
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = f"{type(e).__name__}: {e}"
+
+        registry.record_failure(node)
+
+    return error
+
+async def delete_groups(session: aiohttp.ClientSession, registry: "NodeRegistry", groups: Dict[int, List[str]],
+                        concurrency: int = 4, chunk_size: int = 1000, retries: int = 3) -> Dict[int, List[tuple]]:
+    """
+    Deletes files from many nodes at once. ``groups`` maps node ids to the keys to delete from them.
+    Each node's keys are sent in chunks of ``chunk_size``, with at most ``concurrency`` requests in flight.
+    Returns the outcome of every chunk per node, as ``(keys, error)`` pairs where error is None on success.
+    """
+    sem = asyncio.Semaphore(concurrency)
+    results: Dict[int, List[tuple]] = {node_id: [] for node_id in groups}
+
+    async def run(node_id: int, keys: List[str]):
+        async with sem:
+            error = await mass_delete(session, registry, node_id, keys, retries)
+
+        results[node_id].append((keys, error))
+
+    await asyncio.gather(*(
+        run(node_id, keys[i:i+chunk_size])
+        for node_id, keys in groups.items()
+        for i in range(0, len(keys), chunk_size)
+    ))
+    return results
@@ -0,0 +1,64 @@
+import datetime
+import json
+from typing import Dict, List, Tuple
+
+import asyncpg
+
+COLUMNS = ("image", "node", "restricted", "remote", "accessed", "user_agent", "authorized_user", "response_code")
+
+def parse_events(body: bytes, node: int) -> Tuple[List[tuple], Dict[str, int], int]:
+    """
+    Parses a batch of access events sent by a node, one json object per line.
+    Returns the ``cdn_logs`` records, the view count per image, and how many lines were rejected.
+    Only successful responses count as views.
+    """
+    records = []
+    views = {}
+    rejected = 0
+
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+
+        try:
+            event = json.loads(line)
+            record = (
+                str(event['image']),
+                node,
+                bool(event.get("restricted", False)),
+                str(event['remote']),
+                datetime.datetime.utcfromtimestamp(float(event['accessed'])),
+                str(event.get("user_agent") or ""),
+                event.get("authorized_user") and str(event['authorized_user']),
+                int(event['response_code'])
+            )
+        except (ValueError, TypeError, KeyError, OverflowError, OSError):
+            rejected += 1
+            continue
+
+        records.append(record)
+        if 200 <= record[7] < 400:
+            views[record[0]] = views.get(record[0], 0) + 1
+
+    return records, views, rejected
+
+async def ingest(conn: asyncpg.Connection, node: int, records: List[tuple], views: Dict[str, int]):
+    """
+    Writes a parsed batch with a single COPY into ``cdn_logs`` and a single aggregated view count update.
+    Views on a replica are counted towards the original upload.
+    """
+    async with conn.transaction():
+        if records:
+            await conn.copy_records_to_table("cdn_logs", records=records, columns=COLUMNS)
+
+        if views:
+            await conn.execute("""
+            UPDATE uploads SET views = uploads.views + d.delta
+            FROM (
+                SELECT coalesce(r.key, v.key) AS key, coalesce(r.node, $1) AS node, sum(v.delta) AS delta
+                FROM unnest($2::text[], $3::integer[]) AS v(key, delta)
+                LEFT JOIN upload_replicas r ON r.replica = $1 AND r.replica_key = v.key
+                GROUP BY 1, 2
+            ) AS d
+            WHERE uploads.key = d.key AND uploads.node = d.node
+            """, node, list(views.keys()), list(views.values()))
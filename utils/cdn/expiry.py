@@ -0,0 +1,159 @@
+import asyncio
+import collections
+import logging
+from typing import Dict, List, Optional, TYPE_CHECKING, Union
+
+import aiohttp
+import asyncpg
+
+from utils.cdn import delete
+
+if TYPE_CHECKING:
+    from utils.app import App
+
+logger = logging.getLogger("site.cdn.expiry")
+
+class ExpirySweeper:
+    """
+    Deletes expired uploads in the background.
+    Each sweep soft-deletes up to ``batch_size`` expired uploads (and their replicas), groups them by node, and sends
+    one mass-delete per node, ``concurrency`` nodes at a time. The files are written to ``cdn_dead_letters`` in the
+    same transaction as the soft-delete, and only removed once their node confirms the delete, so a crash mid-sweep
+    can't lose them. Files a node still fails to delete after ``retries`` attempts stay there, and are retried on
+    later sweeps, up to ``max_attempts`` times.
+    """
+    def __init__(self, app: "App", interval: float = 60, batch_size: int = 500, concurrency: int = 4, retries: int = 3,
+                 timeout: float = 30, max_attempts: int = 10):
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.retries = retries
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.expired = 0
+        self.deleted = 0
+        self.dead_lettered = 0
+
+    def start(self):
+        self._session = aiohttp.ClientSession(
+            headers={"Authorization": self.app.settings['slave_key']},
+            timeout=aiohttp.ClientTimeout(total=self.timeout)
+        )
+        self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    def stats(self) -> dict:
+        return {
+            "expired": self.expired,
+            "deleted": self.deleted,
+            "dead_lettered": self.dead_lettered
+        }
+
+    async def _loop(self):
+        while True:
+            try:
+                while await self.sweep() >= self.batch_size: # keep going while there's a backlog
+                    pass
+
+                await self.retry_dead_letters()
+            except Exception as e:
+                logger.error("Failed to sweep expired uploads", exc_info=e)
+
+            await asyncio.sleep(self.interval)
+
+    async def sweep(self) -> int:
+        """
+        Expires one batch of uploads, and returns how many were expired.
+        """
+        async with self.app.db.acquire() as conn:
+            async with conn.transaction():
+                rows = await conn.fetch("""
+                WITH expired AS (
+                    SELECT key, node FROM uploads
+                    WHERE expiry <= (now() at time zone 'utc') AND deleted IS false
+                    ORDER BY expiry
+                    LIMIT $1
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE uploads SET deleted = true
+                FROM expired
+                WHERE uploads.key = expired.key AND uploads.node = expired.node
+                RETURNING uploads.key, uploads.node, uploads.username
+                """, self.batch_size)
+                if not rows:
+                    return 0
+
+                replicas = await conn.fetch("""
+                SELECT replica AS node, replica_key AS key FROM upload_replicas
+                INNER JOIN unnest($1::text[], $2::integer[]) AS e(key, node)
+                    ON upload_replicas.key = e.key AND upload_replicas.node = e.node
+                """, [r['key'] for r in rows], [r['node'] for r in rows])
+
+                # attempts starts at 0, these only count as failed once a node actually refuses them
+                await conn.executemany(
+                    "INSERT INTO cdn_dead_letters (key, node, reason, attempts) VALUES ($1, $2, 'pending', 0) "
+                    "ON CONFLICT DO NOTHING",
+                    [(r['key'], r['node']) for r in (*rows, *replicas)]
+                )
+
+        self.expired += len(rows)
+        for username, count in collections.Counter(r['username'] for r in rows).items():
+            self.app.cdn_stats.deleted(username, count)
+
+        groups: Dict[int, List[str]] = collections.defaultdict(list)
+        for r in (*rows, *replicas):
+            groups[r['node']].append(r['key'])
+
+        await self._delete_groups(groups)
+        return len(rows)
+
+    async def retry_dead_letters(self):
+        async with self.app.db.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT key, node FROM cdn_dead_letters WHERE node = ANY($1) AND attempts < $2 ORDER BY failed LIMIT $3",
+                [n['id'] for n in self.app.cdn_nodes.available_nodes()], self.max_attempts, self.batch_size
+            )
+
+        if not rows:
+            return
+
+        groups: Dict[int, List[str]] = collections.defaultdict(list)
+        for r in rows:
+            groups[r['node']].append(r['key'])
+
+        await self._delete_groups(groups, retrying=True)
+
+    async def _delete_groups(self, groups: Dict[int, List[str]], retrying: bool = False):
+        results = await delete.delete_groups(
+            self._session, self.app.cdn_nodes, groups, self.concurrency, self.batch_size, self.retries
+        )
+
+        for node_id, chunks in results.items():
+            for keys, error in chunks:
+                if error is None:
+                    self.deleted += len(keys)
+                    await self.app.db.execute(
+                        "DELETE FROM cdn_dead_letters WHERE node = $1 AND key = ANY($2)", node_id, keys
+                    )
+                    continue
+
+                logger.warning(f"Could not delete {len(keys)} expired files from node {node_id}: {error}")
+                if not retrying:
+                    self.dead_lettered += len(keys)
+
+                await self.app.db.execute(
+                    "UPDATE cdn_dead_letters SET attempts = attempts + 1, reason = $3, failed = (now() at time zone 'utc') "
+                    "WHERE node = $1 AND key = ANY($2)", node_id, keys, error
+                )
+
+async def dead_letter(db: Union[asyncpg.Connection, asyncpg.Pool], node_id: int, keys: List[str], reason: str):
+    """
+    Records files that couldn't be deleted from a node, so the sweeper can retry them later.
+    """
+    await db.executemany(
+        "INSERT INTO cdn_dead_letters (key, node, reason) VALUES ($1, $2, $3) ON CONFLICT DO NOTHING",
+        [(key, node_id, reason) for key in keys]
+    )
@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Dict, List, Optional, TYPE_CHECKING
+
+import aiohttp
+import yarl
+
+if TYPE_CHECKING:
+    from utils.app import App
+
+GB = 1024 ** 3
+
+logger = logging.getLogger("site.cdn")
+
+def parse_metrics(data: dict) -> dict:
+    """
+    Pulls the load metrics out of a node heartbeat. Nodes that don't report a metric get ``None`` for it.
+    """
+    metrics = {}
+    for key, cast in (("free_space", int), ("inflight", int), ("latency_p95", float)):
+        try:
+            metrics[key] = cast(data[key]) if data.get(key) is not None else None
+        except (TypeError, ValueError):
+            metrics[key] = None
+
+    return metrics
+
+def load_score(node: dict, inflight: int = 0) -> float:
+    """
+    Lower is better. In-flight uploads and latency scale the score up, and so does running low on disk.
+    ``inflight`` is the number of uploads the master itself has in flight to the node.
+    """
+    metrics = node.get("metrics") or {}
+    inflight = max(inflight, metrics.get("inflight") or 0)
+    latency = metrics.get("latency_p95") or 0
+    score = (1 + inflight) * (1 + latency)
+
+    free = metrics.get("free_space")
+    if free is not None:
+        score *= 1 + GB / max(free, 1)
+
+    return score
+
+def choose_node(candidates: List[dict], inflight: Dict[int, int], min_free_space: int = GB) -> Optional[dict]:
+    """
+    Picks a node using the power of two choices: two random candidates are compared, and the less loaded one wins.
+    Nodes reporting less than ``min_free_space`` bytes free are never picked.
+    """
+    candidates = [
+        n for n in candidates
+        if (n.get("metrics") or {}).get("free_space") is None or n['metrics']['free_space'] >= min_free_space
+    ]
+    if not candidates:
+        return None
+
+    if len(candidates) == 1:
+        return candidates[0]
+
+    a, b = random.sample(candidates, 2)
+    return min(a, b, key=lambda n: load_score(n, inflight.get(n['id'], 0)))
+
+def choose_nodes(candidates: List[dict], inflight: Dict[int, int], count: int, min_free_space: int = GB) -> List[dict]:
+    """
+    Picks up to ``count`` distinct nodes with :func:`choose_node`. The first node is the primary.
+    """
+    candidates = list(candidates)
+    chosen = []
+    while len(chosen) < count:
+        node = choose_node(candidates, inflight, min_free_space)
+        if node is None:
+            break
+
+        chosen.append(node)
+        candidates.remove(node)
+
+    return chosen
+
+class NodeRegistry:
+    """
+    Tracks the cdn nodes and their health. Known nodes are loaded from the ``slaves`` table at startup,
+    and every node is probed on an interval. Each node has a circuit breaker:
+
+    - ``closed``: the node is healthy and can be used.
+    - ``open``: the node failed ``threshold`` times in a row, and won't be used until ``cooldown`` seconds pass.
+    - ``half-open``: the cooldown passed; the next probe decides whether the node closes or opens again.
+
+    Reads and deletes may go to half-open nodes, but uploads only go to closed ones (see :meth:`upload_nodes`),
+    so a node that is still recovering isn't handed user files.
+    """
+    def __init__(self, app: "App", interval: float = 15, timeout: float = 5, threshold: int = 3, cooldown: float = 60):
+        self.app = app
+        self.interval = interval
+        self.timeout = timeout
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.nodes: Dict[int, dict] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        data = await self.app.db.fetch("SELECT node, name, ip, port FROM slaves")
+        for record in data:
+            self.nodes[record['node']] = self._new_node(record['node'], record['name'], record['ip'], record['port'], None)
+            self.nodes[record['node']]['state'] = "half-open" # unknown until the first probe
+
+        logger.info(f"Loaded {len(self.nodes)} cdn nodes")
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        self._task = asyncio.get_running_loop().create_task(self._probe_loop())
+
+    def _new_node(self, node_id: int, name: str, ip: str, port: int, metrics: Optional[dict]) -> dict:
+        return {
+            "ip": ip,
+            "port": port,
+            "name": name,
+            "id": node_id,
+            "signin": None,
+            "metrics": metrics or {},
+            "state": "closed",
+            "failures": 0,
+            "opened": None,
+            "last_probe": None
+        }
+
+    def heartbeat(self, node_id: int, name: str, ip: str, port: int, metrics: dict) -> dict:
+        node = self.nodes.get(node_id)
+        if node is None or (node['ip'], node['port']) != (ip, port):
+            node = self.nodes[node_id] = self._new_node(node_id, name, ip, port, metrics)
+        else:
+            node['name'] = name
+            node['metrics'] = metrics
+
+        node['signin'] = time.time()
+        self.record_success(node)
+        return node
+
+    def get(self, node: str) -> Optional[dict]:
+        """
+        Finds a node by id or name.
+        """
+        if node.isnumeric():
+            return self.nodes.get(int(node))
+
+        for n in self.nodes.values():
+            if n['name'].lower() == node.lower():
+                return n
+
+        return None
+
+    def available(self, node: dict) -> bool:
+        if node['state'] == "open" and time.time() - node['opened'] >= self.cooldown:
+            node['state'] = "half-open"
+
+        return node['state'] != "open"
+
+    def available_nodes(self) -> List[dict]:
+        return [n for n in self.nodes.values() if self.available(n)]
+
+    def upload_nodes(self) -> List[dict]:
+        """
+        Returns the nodes that new uploads can be stored on. The probe is the half-open trial, not an upload.
+        """
+        return [n for n in self.available_nodes() if n['state'] == "closed"]
+
+    def healthiest(self, node_ids: List[int], inflight: Dict[int, int]) -> Optional[dict]:
+        """
+        Returns the least loaded available node out of ``node_ids``, or None if none of them are available.
+        """
+        options = [self.nodes[i] for i in node_ids if i in self.nodes and self.available(self.nodes[i])]
+        if not options:
+            return None
+
+        return min(options, key=lambda n: (n['state'] != "closed", load_score(n, inflight.get(n['id'], 0))))
+
+    def record_success(self, node: dict):
+        node['failures'] = 0
+        node['state'] = "closed"
+        node['opened'] = None
+
+    def record_failure(self, node: dict):
+        node['failures'] += 1
+        if node['state'] == "half-open" or node['failures'] >= self.threshold:
+            if node['state'] != "open":
+                logger.warning(f"cdn node {node['name']} ({node['id']}) is unavailable")
+
+            node['state'] = "open"
+            node['opened'] = time.time()
+
+    async def probe(self, node: dict):
+        url = yarl.URL(f"http://{node['ip']}").with_port(node['port'])
+        node['last_probe'] = time.time()
+        try:
+            async with self._session.get(url) as resp:
+                healthy = resp.status < 500 # any answer means the node is up
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            healthy = False
+
+        if healthy:
+            self.record_success(node)
+        else:
+            self.record_failure(node)
+
+    async def _probe_loop(self):
+        while True:
+            try:
+                await asyncio.gather(*(self.probe(n) for n in self.available_nodes()))
+            except Exception as e:
+                logger.error("Failed to probe the cdn nodes", exc_info=e)
+
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,91 @@
+import asyncio
+import collections
+import datetime
+import logging
+from typing import Dict, Optional, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from utils.app import App
+
+logger = logging.getLogger("site.cdn.stats")
+
+class CDNStats:
+    """
+    Keeps the cdn statistics in memory, so the stats endpoints don't have to count the uploads table on every call.
+    Uploads and deletes update the counters as they happen, and the counters are rebuilt from the database every
+    ``interval`` seconds to correct any drift.
+    """
+    def __init__(self, app: "App", interval: float = 600):
+        self.app = app
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+        self.total = 0
+        self.users: Dict[str, int] = collections.Counter()
+        self.hours: Dict[datetime.datetime, int] = collections.Counter() # uploads per hour, for the last 24 hours
+        self.last_upload: Optional[Tuple[str, str]] = None # (node name, key)
+        self._user_last: Dict[str, Tuple[str, str]] = {}
+
+    async def start(self):
+        await self.reconcile()
+        self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.error("Failed to reconcile the cdn stats", exc_info=e)
+
+    async def reconcile(self):
+        async with self.app.db.acquire() as conn:
+            users = await conn.fetch("SELECT username, COUNT(*) FROM uploads WHERE deleted IS false GROUP BY username")
+            hours = await conn.fetch("""
+            SELECT date_trunc('hour', time) AS hour, COUNT(*) FROM uploads
+            WHERE time > (now() at time zone 'utc') - INTERVAL '1 day'
+            GROUP BY hour
+            """)
+            last = await conn.fetch("""
+            SELECT DISTINCT ON (username) username, key, slaves.name FROM uploads
+            INNER JOIN slaves ON slaves.node = uploads.node
+            WHERE deleted IS false
+            ORDER BY username, time DESC
+            """)
+            latest = await conn.fetchrow("""
+            SELECT key, slaves.name FROM uploads
+            INNER JOIN slaves ON slaves.node = uploads.node
+            WHERE deleted IS false
+            ORDER BY time DESC LIMIT 1
+            """)
+
+        self.users = collections.Counter({r['username']: r['count'] for r in users})
+        self.total = sum(self.users.values())
+        self.hours = collections.Counter({r['hour']: r['count'] for r in hours})
+        self._user_last = {r['username']: (r['name'], r['key']) for r in last}
+        self.last_upload = latest and (latest['name'], latest['key'])
+
+    def _prune(self, now: datetime.datetime):
+        cutoff = now - datetime.timedelta(days=1)
+        for hour in [h for h in self.hours if h + datetime.timedelta(hours=1) <= cutoff]:
+            del self.hours[hour]
+
+    @property
+    def today(self) -> int:
+        self._prune(datetime.datetime.utcnow())
+        return sum(self.hours.values())
+
+    def user_last_upload(self, username: str) -> Optional[Tuple[str, str]]:
+        return self._user_last.get(username)
+
+    def uploaded(self, username: str, node: str, key: str, time: datetime.datetime):
+        self.total += 1
+        self.users[username] += 1
+        self.hours[time.replace(minute=0, second=0, microsecond=0)] += 1
+        self.last_upload = self._user_last[username] = (node, key)
+
+    def deleted(self, username: str, count: int = 1):
+        self.total = max(0, self.total - count)
+        self.users[username] = max(0, self.users[username] - count)
+        # the user's previous upload isn't known here, so the next reconcile fills it back in
+        self._user_last.pop(username, None)
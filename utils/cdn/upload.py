@@ -0,0 +1,206 @@
+import asyncio
+import collections
+import io
+import json
+import time
+from typing import AsyncIterator, Deque, Dict, List, Optional, Union
+
+import aiohttp
+import yarl
+
+class UploadTooLarge(Exception):
+    pass
+
+class UploadTimeout(Exception):
+    pass
+
+class NodeError(Exception):
+    def __init__(self, status: int, text: str):
+        self.status = status
+        self.text = text
+        super().__init__(f"child node error: {text}")
+
+class UploadPipeline:
+    """
+    Streams uploads from the master to the cdn nodes.
+    The request body is read one chunk at a time, and the next chunk is only read once the node has accepted the
+    previous one, so a slow node slows down the uploader instead of the master buffering the body.
+    """
+    def __init__(self, slave_key: str, max_size: int = 100 * 1024 * 1024, timeout: float = 300,
+                 idle_timeout: float = 30, chunk_size: int = 64 * 1024):
+        self.slave_key = slave_key
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.chunk_size = chunk_size
+        self._session: Optional[aiohttp.ClientSession] = None
+
+        self.active = 0
+        self.inflight: Dict[int, int] = {} # node id: uploads in flight to that node
+        self.completed = 0
+        self.failed = 0
+        self.bytes = 0
+        self._throughput: Deque[float] = collections.deque(maxlen=256) # bytes/sec of recent uploads
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout, sock_read=self.idle_timeout)
+            )
+
+        return self._session
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "completed": self.completed,
+            "failed": self.failed,
+            "bytes": self.bytes,
+            "bytes_per_second": sum(self._throughput) / len(self._throughput) if self._throughput else 0,
+            "max_size": self.max_size
+        }
+
+    async def _body(self, source: Union[bytes, io.BytesIO, aiohttp.StreamReader], state: dict) -> AsyncIterator[bytes]:
+        if isinstance(source, io.BytesIO):
+            source = source.getvalue()
+
+        if isinstance(source, (bytes, bytearray)):
+            source = memoryview(source)
+            for i in range(0, len(source), self.chunk_size):
+                chunk = bytes(source[i:i+self.chunk_size])
+                state['bytes'] += len(chunk)
+                yield chunk
+            return
+
+        while True:
+            try:
+                chunk = await asyncio.wait_for(source.read(self.chunk_size), self.idle_timeout)
+            except asyncio.TimeoutError:
+                state['error'] = UploadTimeout()
+                raise state['error'] from None
+
+            if not chunk:
+                return
+
+            state['bytes'] += len(chunk)
+            if state['bytes'] > self.max_size:
+                state['error'] = UploadTooLarge()
+                raise state['error']
+
+            yield chunk
+
+    async def _drain(self, queue: asyncio.Queue, source_state: dict, state: dict) -> AsyncIterator[bytes]:
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                if source_state['error'] is not None: # abort, so the node doesn't keep a truncated file
+                    state['error'] = source_state['error']
+                    raise state['error']
+                return
+
+            state['bytes'] += len(chunk)
+            yield chunk
+
+    async def upload(self, target: dict, source: Union[bytes, io.BytesIO, aiohttp.StreamReader], content_type: str,
+                     filename: str, name: str = None) -> dict:
+        """
+        Streams ``source`` to the ``target`` node, and returns the node's response.
+        Raises :class:`UploadTooLarge`, :class:`UploadTimeout` or :class:`NodeError`.
+        """
+        state = {"bytes": 0, "error": None}
+        return await self._send(target, self._body(source, state), state, content_type, filename, name)
+
+    async def replicate(self, targets: List[dict], source: Union[bytes, io.BytesIO, aiohttp.StreamReader],
+                        content_type: str, filename: str, name: str = None) -> List[Union[dict, Exception]]:
+        """
+        Streams ``source`` to every node in ``targets`` at once. The body is only read once: each chunk is handed to
+        every node before the next one is read, so the slowest node sets the pace. A node failing doesn't stop the others.
+        Returns the node's response or the exception it raised for each target, in order.
+        Raises :class:`UploadTooLarge` or :class:`UploadTimeout` if reading the body fails.
+        """
+        state = {"bytes": 0, "error": None}
+        queues = [asyncio.Queue(maxsize=4) for _ in targets]
+        live = list(queues)
+
+        async def feed():
+            try:
+                async for chunk in self._body(source, state):
+                    if not live:
+                        return
+
+                    for queue in list(live):
+                        await queue.put(chunk)
+            except (UploadTooLarge, UploadTimeout):
+                pass
+            finally:
+                for queue in list(live):
+                    await queue.put(None)
+
+        async def send(target: dict, queue: asyncio.Queue):
+            sub = {"bytes": 0, "error": None}
+            try:
+                return await self._send(target, self._drain(queue, state, sub), sub, content_type, filename, name)
+            finally:
+                # stop feeding this node, and unblock the feeder if it's waiting on this queue
+                if queue in live:
+                    live.remove(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+
+        feeder = asyncio.get_running_loop().create_task(feed())
+        try:
+            results = await asyncio.gather(*(send(t, q) for t, q in zip(targets, queues)), return_exceptions=True)
+            await feeder
+        finally:
+            feeder.cancel()
+
+        if state['error'] is not None:
+            raise state['error']
+
+        return results
+
+    async def _send(self, target: dict, body: AsyncIterator[bytes], state: dict, content_type: str, filename: str,
+                    name: Optional[str]) -> dict:
+        url = yarl.URL(f"http://{target['ip']}").with_port(target['port']).with_path("create")
+        # use http to directly access the backend, cuz it probably isnt behind nginx
+        if name is not None:
+            url = url.with_query(name=name)
+
+        start = time.monotonic()
+        self.active += 1
+        self.inflight[target['id']] = self.inflight.get(target['id'], 0) + 1
+        try:
+            async with self.session.post(url, data=body,
+                                         headers={
+                                             "Authorization": self.slave_key,
+                                             "Content-Type": content_type,
+                                             "File-Name": filename
+                                         }) as resp:
+                text = await resp.text()
+                if not 200 <= resp.status < 300:
+                    raise NodeError(resp.status, text)
+
+                data = json.loads(text)
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.failed += 1
+            if state['error'] is not None: # errors raised while reading the body surface as connection errors
+                raise state['error'] from None
+            if isinstance(e, asyncio.TimeoutError):
+                raise UploadTimeout from None
+            raise
+        except:
+            self.failed += 1
+            raise
+        finally:
+            self.active -= 1
+            self.inflight[target['id']] -= 1
+            if not self.inflight[target['id']]:
+                del self.inflight[target['id']]
+
+        elapsed = time.monotonic() - start
+        self.completed += 1
+        self.bytes += state['bytes']
+        self._throughput.append(state['bytes'] / elapsed if elapsed else 0)
+        return data
@@ -1,6 +1,8 @@
 import math
-from typing import Tuple, Optional
+import time
+from typing import Tuple, Optional, Union
 
+import asyncpg
 from aiohttp import web
 from discord.ext.commands import CooldownMapping, BucketType, Cooldown
 
@@ -53,11 +55,13 @@ class BannedResponse(web.Response):
 
 
 class Handler:
-    __slots__ = "rate", "per", "ignore_perm", "cb", "map", "autoban", "auth_map", "auth_autoban", "ignore_logging"
+    __slots__ = "rate", "per", "ignore_perm", "cb", "map", "autoban", "auth_map", "auth_autoban", "ignore_logging", \
+                "hold_connection"
 
-    def __init__(self, rate: int, per: int, callback, ignore_perms: str=None, ignore_logging=False):
+    def __init__(self, rate: int, per: int, callback, ignore_perms: str=None, ignore_logging=False, hold_connection=True):
         self.rate = rate
         self.per = per
+        self.hold_connection = hold_connection
 
         self.ignore_logging = ignore_logging
         self.ignore_perm = ignore_perms
@@ -77,22 +81,37 @@ class Handler:
         return self._wrap_call(request)
 
     async def _wrap_call(self, request: utils.TypedRequest):
+        if not self.hold_connection:
+            # the pool hands out a connection per query, so slow callbacks don't pin one for the whole request
+            return await self._logged_call(request, request.app.db)
+
         async with request.app.db.acquire() as conn:
-            request.conn = conn
-            resp, login, did_ban = await self.do_call(request, conn)
-            if not self.ignore_logging:
-                if isinstance(resp, BannedResponse) and not did_ban:
-                    return resp
-
-                await conn.execute(
-                    "INSERT INTO logs VALUES ($1, (now() at time zone 'utc'), $2, $3, $4, $5)",
-                    request.headers.get("X-Forwarded-For") or request.remote,
-                    request.headers.get("User-Agent", "!!Not given!!"),
-                    request.path,
-                    login,
-                    resp.status
-                )
-            return resp
+            return await self._logged_call(request, conn)
+
+    async def _logged_call(self, request: utils.TypedRequest, conn: Union[asyncpg.Connection, asyncpg.Pool]):
+        request.conn = conn
+        start = time.perf_counter()
+        resp, login, did_ban = await self.do_call(request, conn)
+        if not self.ignore_logging:
+            if isinstance(resp, BannedResponse) and not did_ban:
+                return resp
+
+            request.app.rollups.record(
+                request.headers.get("X-Forwarded-For") or request.remote,
+                login,
+                request.match_info.route.resource.canonical if request.match_info.route.resource else request.path,
+                resp.status,
+                time.perf_counter() - start
+            )
+            await conn.execute(
+                "INSERT INTO logs VALUES ($1, (now() at time zone 'utc'), $2, $3, $4, $5)",
+                request.headers.get("X-Forwarded-For") or request.remote,
+                request.headers.get("User-Agent", "!!Not given!!"),
+                request.path,
+                login,
+                resp.status
+            )
+        return resp
 
     async def do_call(self, request: utils.TypedRequest, conn) -> Tuple[web.Response, Optional[str], bool]:
         ip = request.headers.get("X-Forwarded-For") or request.remote
@@ -172,7 +191,12 @@ class Handler:
 
         return response, data['username'] if data else None, False
 
-def ratelimit(rate: int, per: int, ignore_perm: str=None, ignore_logging=False):
+def ratelimit(rate: int, per: int, ignore_perm: str=None, ignore_logging=False, hold_connection=True):
+    """
+    Wraps a route in the ban, auth, permission and ratelimit checks, and logs the request.
+    With ``hold_connection=False`` the route gets the pool instead of a connection, for routes that spend most of their
+    time waiting on something other than the database, and should acquire a connection only when they need one.
+    """
     def wrapped(func):
-        return Handler(rate, per, func, ignore_perm, ignore_logging)
+        return Handler(rate, per, func, ignore_perm, ignore_logging, hold_connection)
     return wrapped
@@ -0,0 +1,91 @@
+import datetime
+import json
+import pathlib
+from typing import List, Tuple
+
+import asyncpg
+
+MIGRATIONS = pathlib.Path("migrations")
+
+# (name, table, query, args) for the queries on the request path. Each should be able to use an index on its table.
+HOT_QUERIES = [
+    ("auth lookup", "auths", "SELECT * FROM auths WHERE auth_key = $1 AND auth_key IS NOT NULL", ("token",)),
+    ("ban lookup", "bans", "SELECT reason FROM bans WHERE ip = $1", ("127.0.0.1",)),
+    ("ban expiry", "bans", "DELETE FROM bans WHERE expires is not null and expires <= (now() at time zone 'utc')", ()),
+    ("cdn listing", "uploads",
+     "SELECT key, node, time FROM uploads WHERE deleted IS false ORDER BY uploads.time, uploads.key, uploads.node LIMIT 1000", ()),
+    ("cdn user listing", "uploads",
+     "SELECT key, node, size, time FROM uploads WHERE username = $1 AND deleted is false "
+     "ORDER BY uploads.time, uploads.key, uploads.node LIMIT 1000", ("user",)),
+    ("cdn expiry", "uploads",
+     "SELECT key, node FROM uploads WHERE expiry <= (now() at time zone 'utc') AND deleted IS false ORDER BY expiry LIMIT 500", ()),
+    ("cdn replica lookup", "upload_replicas",
+     "SELECT key, node FROM upload_replicas WHERE replica = $1 AND replica_key = ANY($2)", (1, ["key"])),
+    ("rtfm cache", "rtfm_lookup", "SELECT key, value, is_label FROM rtfm_lookup WHERE url = $1", ("https://example.com",)),
+    ("xkcd tags", "xkcd", "SELECT num FROM xkcd WHERE extra_tags @> ARRAY[$1]::text[]", ("tag",)),
+    ("log range", "logs", "SELECT * FROM logs WHERE accessed >= $1", (datetime.datetime(2021, 1, 1),)),
+    ("log page", "logs",
+     "SELECT * FROM logs WHERE (accessed, id) < ($1, $2) ORDER BY accessed DESC, id DESC LIMIT 50",
+     (datetime.datetime(2021, 1, 1), 1)),
+    ("log endpoint filter", "logs",
+     "SELECT * FROM logs WHERE endpoint = $1 ORDER BY accessed DESC, id DESC LIMIT 50", ("/api/public/rtfm",)),
+    ("cdn log range", "cdn_logs", "SELECT * FROM cdn_logs WHERE accessed >= $1", (datetime.datetime(2021, 1, 1),)),
+]
+
+async def applied(conn: asyncpg.Connection) -> set:
+    await conn.execute("""
+    create table if not exists schema_migrations (
+        version integer primary key,
+        name text not null,
+        applied timestamp not null default (now() at time zone 'utc')
+    )
+    """)
+    return {r['version'] for r in await conn.fetch("SELECT version FROM schema_migrations")}
+
+async def migrate(conn: asyncpg.Connection, path: pathlib.Path = MIGRATIONS) -> List[str]:
+    """
+    Applies the migrations in ``path`` that haven't been applied yet, in order, each in its own transaction.
+    Migration files are named ``<version>_<name>.sql``. Returns the names of the migrations that were applied.
+    """
+    done = await applied(conn)
+    ran = []
+    for file in sorted(path.glob("*.sql")):
+        version, _, name = file.stem.partition("_")
+        if int(version) in done:
+            continue
+
+        async with conn.transaction():
+            await conn.execute(file.read_text())
+            await conn.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", int(version), name)
+
+        ran.append(file.stem)
+
+    return ran
+
+def _seq_scans(plan: dict, table: str) -> bool:
+    relation = plan.get("Relation Name") or ""
+    if plan.get("Node Type") == "Seq Scan" and (relation == table or relation.startswith(f"{table}_p")):
+        # partitioned tables are scanned through their partitions, the default partition is expected to be empty
+        return True
+
+    return any(_seq_scans(p, table) for p in plan.get("Plans", []))
+
+async def check_plans(conn: asyncpg.Connection) -> List[Tuple[str, str]]:
+    """
+    EXPLAINs every query in :data:`HOT_QUERIES` and returns the ones that can only be answered with a sequential scan,
+    as ``(name, plan)`` pairs. Sequential scans are disabled while planning, so that small test tables still show
+    whether an index is usable.
+    """
+    failures = []
+    tr = conn.transaction()
+    await tr.start()
+    try:
+        await conn.execute("SET LOCAL enable_seqscan = off")
+        for name, table, query, args in HOT_QUERIES:
+            plan = json.loads(await conn.fetchval(f"EXPLAIN (FORMAT JSON) {query}", *args))[0]['Plan']
+            if _seq_scans(plan, table):
+                failures.append((name, json.dumps(plan, indent=2)))
+    finally:
+        await tr.rollback()
+
+    return failures
@@ -1,18 +1,397 @@
 import asyncio
-import pathlib
-from concurrent.futures import ThreadPoolExecutor
+import collections
+import datetime
+import hashlib
+import io
+import json
+import logging
+import math
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Optional, Tuple, Union
 
-from PIL import Image
+import asyncpg
+import cv2
+import numpy as np
+from PIL import Image, UnidentifiedImageError
 
 import pytesseract
 
-pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="OCR_Worker")
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
 
-def _do_img(path):
+logger = logging.getLogger("site.ocr")
+
+TESSDATA = "/opt/tessdata/"
+OCR_CONFIG = f"--tessdata-dir {TESSDATA}"
+
+_api = None # the tesserocr handle owned by this worker process
+_preprocess: dict = {}
+
+DEFAULT_PREPROCESS = {
+    "enabled": True,
+    "max_size": 2000, # longest edge in pixels, larger images are downscaled
+    "invert_dark": True,
+    # binarizing and cropping are off until bench_ocr.py shows they help on real uploads
+    "threshold": False,
+    "crop": False,
+    "crop_padding": 10
+}
+
+def _init_worker(preprocess: dict = None, engine: str = None):
+    # runs once in each worker process, so the language models are loaded once rather than per image
+    global _api, _preprocess
+    _preprocess = {**DEFAULT_PREPROCESS, **(preprocess or {})}
+
+    if tesserocr is None or engine == "pytesseract":
+        return
+
+    try:
+        _api = tesserocr.PyTessBaseAPI(path=TESSDATA)
+    except RuntimeError:
+        _api = None
+
+def preprocess(img: Image.Image, max_size: int = 2000, invert_dark: bool = True, threshold: bool = False,
+               crop: bool = False, crop_padding: int = 10, **_) -> Image.Image:
+    """
+    Prepares an image for tesseract: grayscale, downscale, invert dark themes, binarize and crop to the text.
+    """
+    arr = np.asarray(img.convert("L"))
+
+    h, w = arr.shape
+    scale = max_size / max(h, w)
+    if scale < 1:
+        arr = cv2.resize(arr, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+
+    if invert_dark and arr.mean() < 128: # tesseract wants dark text on a light background
+        arr = cv2.bitwise_not(arr)
+
+    if threshold:
+        _, arr = cv2.threshold(arr, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+
+    if crop:
+        ys, xs = np.nonzero(arr < 128)
+        if len(ys):
+            h, w = arr.shape
+            arr = arr[
+                max(0, ys.min() - crop_padding):min(h, ys.max() + crop_padding + 1),
+                max(0, xs.min() - crop_padding):min(w, xs.max() + crop_padding + 1)
+            ]
+
+    return Image.fromarray(arr)
+
+def _do_img(data: Union[bytes, str]):
     try:
-        return pytesseract.image_to_string(Image.open(path), config="--tessdata-dir /opt/tessdata/")
+        img = Image.open(io.BytesIO(data) if isinstance(data, bytes) else data)
+        if _preprocess.get("enabled"):
+            img = preprocess(img, **_preprocess)
+
+        if _api is not None:
+            _api.SetImage(img)
+            return _api.GetUTF8Text()
+
+        return pytesseract.image_to_string(img, config=OCR_CONFIG)
     except RuntimeError:
         return None
+    except Exception as e:
+        # some pytesseract errors can't be unpickled, which would break the whole pool on the way back to the master
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+
+class ImageTooLarge(Exception):
+    pass
+
+class InvalidImage(Exception):
+    pass
+
+class QueueFull(Exception):
+    def __init__(self, retry_after: int):
+        self.retry_after = retry_after
+        super().__init__("The OCR queue is full")
+
+class OCRScheduler:
+    """
+    A bounded, per-user fair queue in front of the OCR worker processes.
+    Jobs are handed to the workers round-robin across users. While other users are waiting, a single user can't
+    hold more than ``per_user`` workers at once, so one token can't starve everyone else; when nobody else is
+    waiting, a user may use every idle worker.
+
+    ``engine`` picks how the workers run tesseract: ``"tesserocr"`` keeps one loaded instance per worker,
+    ``"pytesseract"`` spawns tesseract per image, and None uses tesserocr when it's installed.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, workers: int = 2, queue_size: int = 16, per_user: int = 1,
+                 preprocess: dict = None, engine: str = None):
+        if engine not in (None, "tesserocr", "pytesseract"):
+            raise ValueError(f"unknown OCR engine {engine!r}")
+        if engine == "tesserocr" and tesserocr is None:
+            raise ValueError("the tesserocr engine was requested, but tesserocr is not installed")
+
+        self.loop = loop
+        self.workers = workers
+        self.preprocess = preprocess
+        self.engine = engine
+        self.queue_size = queue_size
+        self.per_user = per_user
+        self.pool = self._make_pool()
+        if tesserocr is None and engine is None:
+            logger.warning("tesserocr is not installed, OCR workers will fall back to spawning tesseract per image")
+
+        self._queues: Dict[str, Deque[Tuple[asyncio.Future, Callable, tuple, float]]] = collections.OrderedDict()
+        self._running: Dict[str, int] = {}
+        self._queued = 0
+
+        self.completed = 0
+        self.rejected = 0
+        self._waits: Deque[float] = collections.deque(maxlen=256)
+        self._runtimes: Deque[float] = collections.deque(maxlen=256)
+
+    def _make_pool(self) -> ProcessPoolExecutor:
+        # forkserver workers start from a clean process instead of a copy of the master's event loop and sockets
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=_init_worker,
+            initargs=(self.preprocess, self.engine)
+        )
+
+    @property
+    def depth(self) -> int:
+        return self._queued
+
+    @property
+    def running(self) -> int:
+        return sum(self._running.values())
+
+    def retry_after(self) -> int:
+        runtime = sum(self._runtimes) / len(self._runtimes) if self._runtimes else 5
+        return max(1, math.ceil(runtime * (self._queued + 1) / self.workers))
+
+    def stats(self) -> dict:
+        waits = sorted(self._waits)
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "queue_depth": self._queued,
+            "queue_size": self.queue_size,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "wait_p50": waits[len(waits) // 2] if waits else 0,
+            "wait_p95": waits[int(len(waits) * 0.95)] if waits else 0,
+            "runtime_avg": sum(self._runtimes) / len(self._runtimes) if self._runtimes else 0
+        }
+
+    def check_capacity(self):
+        """
+        Raises :class:`QueueFull` if the queue is at capacity, so callers can refuse a job before reading its upload.
+        """
+        if self._queued >= self.queue_size:
+            self.rejected += 1
+            raise QueueFull(self.retry_after())
+
+    def submit(self, user: str, func: Callable, *args) -> "asyncio.Future[Any]":
+        """
+        Queues ``func(*args)`` to be run on the worker pool on behalf of ``user``.
+        Raises :class:`QueueFull` if the queue is at capacity.
+        """
+        self.check_capacity()
+        fut = self.loop.create_future()
+        self._queues.setdefault(user, collections.deque()).append((fut, func, args, time.monotonic()))
+        self._queued += 1
+        self._dispatch()
+        return fut
+
+    def _dispatch(self):
+        progress = True
+        while progress:
+            progress = False
+            for user in list(self._queues.keys()):
+                if self.running >= self.workers:
+                    return
+
+                # the cap only matters while someone else is waiting, otherwise it leaves workers idle
+                if self._running.get(user, 0) >= self.per_user and len(self._queues) > 1:
+                    continue
+
+                queue = self._queues.pop(user)
+                fut, func, args, enqueued = queue.popleft()
+                self._queued -= 1
+                progress = True
+                if queue:
+                    self._queues[user] = queue # move to the back of the line
+
+                if fut.cancelled(): # the client went away while waiting
+                    continue
+
+                self._waits.append(time.monotonic() - enqueued)
+                self._running[user] = self._running.get(user, 0) + 1
+                self.loop.create_task(self._run(user, fut, func, args))
+
+    async def _run(self, user: str, fut: asyncio.Future, func: Callable, args: tuple):
+        start = time.monotonic()
+        pool = self.pool
+        try:
+            result = await self.loop.run_in_executor(pool, func, *args)
+        except BrokenProcessPool as e:
+            if self.pool is pool: # every job on the broken pool fails, only the first one replaces it
+                logger.error("An OCR worker died, restarting the pool", exc_info=e)
+                self.pool = self._make_pool()
+                pool.shutdown(wait=False)
+
+            if not fut.done():
+                fut.set_exception(e)
+        except Exception as e:
+            if not fut.done():
+                fut.set_exception(e)
+        else:
+            if not fut.done():
+                fut.set_result(result)
+        finally:
+            self._runtimes.append(time.monotonic() - start)
+            self.completed += 1
+            self._running[user] -= 1
+            if not self._running[user]:
+                del self._running[user]
+
+            self._dispatch()
+
+class OCRCache:
+    """
+    Caches OCR results by a hash of the image bytes and the OCR config.
+    Results are kept in an in-memory LRU, and optionally in the ``ocr_cache`` table for ``ttl`` seconds.
+    """
+    def __init__(self, size: int = 512, use_db: bool = False, ttl: int = 60*60*24*7, preprocess: dict = None):
+        self.size = size
+        self.preprocess = {**DEFAULT_PREPROCESS, **(preprocess or {})}
+        self.use_db = use_db
+        self.ttl = ttl
+        self._lru: "collections.OrderedDict[str, str]" = collections.OrderedDict()
+
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def hasher(self):
+        h = hashlib.blake2b(digest_size=20)
+        h.update(OCR_CONFIG.encode())
+        h.update(b"tesserocr" if tesserocr is not None else b"pytesseract")
+        h.update(json.dumps(self.preprocess, sort_keys=True).encode())
+        return h
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.db_hits + self.misses
+        return {
+            "size": len(self._lru),
+            "memory_hits": self.memory_hits,
+            "db_hits": self.db_hits,
+            "misses": self.misses,
+            "hit_ratio": (self.memory_hits + self.db_hits) / lookups if lookups else 0
+        }
+
+    def _remember(self, key: str, result: str):
+        self._lru[key] = result
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.size:
+            self._lru.popitem(last=False)
+
+    async def get(self, key: str, conn: Union[asyncpg.Connection, asyncpg.Pool]) -> Optional[str]:
+        if key in self._lru:
+            self._lru.move_to_end(key)
+            self.memory_hits += 1
+            return self._lru[key]
+
+        if self.use_db:
+            result = await conn.fetchval(
+                "SELECT result FROM ocr_cache WHERE hash = $1 AND created > (now() at time zone 'utc') - $2::interval",
+                key, datetime.timedelta(seconds=self.ttl)
+            )
+            if result is not None:
+                self.db_hits += 1
+                self._remember(key, result)
+                return result
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, result: str, conn: Union[asyncpg.Connection, asyncpg.Pool]):
+        self._remember(key, result)
+        if self.use_db:
+            await conn.execute(
+                "INSERT INTO ocr_cache VALUES ($1, $2) ON CONFLICT (hash) DO UPDATE SET result = $2, created = (now() at time zone 'utc')",
+                key, result
+            )
+
+    async def purge_expired(self, db: asyncpg.Pool):
+        if self.use_db:
+            await db.execute(
+                "DELETE FROM ocr_cache WHERE created <= (now() at time zone 'utc') - $1::interval",
+                datetime.timedelta(seconds=self.ttl)
+            )
+
+async def do_ocr(scheduler: OCRScheduler, user: str, data: Union[bytes, str]):
+    return await scheduler.submit(user, _do_img, data)
+
+async def do_cached_ocr(scheduler: OCRScheduler, cache: OCRCache, user: str, data: Union[bytes, str], key: str,
+                        conn: Union[asyncpg.Connection, asyncpg.Pool]) -> Optional[str]:
+    """
+    Serves the result from the cache if possible, otherwise runs the OCR and caches the result.
+    """
+    result = await cache.get(key, conn)
+    if result is None:
+        result = await do_ocr(scheduler, user, data)
+        if result is not None:
+            await cache.put(key, result, conn)
+
+    return result
+
+async def buffer_image(chunks: AsyncIterator[bytes], max_size: int, spill_size: int, hasher=None) -> Union[bytes, str]:
+    """
+    Reads an uploaded image into memory. Uploads larger than ``spill_size`` are spilled to a temporary file,
+    in which case the path is returned instead of the bytes, and the caller is responsible for removing it.
+    If ``hasher`` is passed, it's updated with the image bytes as they arrive.
+    Raises :class:`ImageTooLarge` past ``max_size`` bytes, and :class:`InvalidImage` if PIL can't identify the image.
+    """
+    loop = asyncio.get_running_loop()
+    buffer = bytearray()
+    spill = None
+    size = 0
+
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > max_size:
+                raise ImageTooLarge
+
+            if hasher is not None:
+                hasher.update(chunk)
+
+            if spill is None and size > spill_size:
+                spill = tempfile.NamedTemporaryFile(prefix="ocr-", delete=False)
+                chunk, buffer = bytes(buffer + chunk), bytearray()
+
+            if spill is not None:
+                await loop.run_in_executor(None, spill.write, chunk)
+            else:
+                buffer += chunk
+
+        if spill is not None:
+            spill.close()
+
+        try:
+            # only reads the header, the actual decode happens in the worker
+            with Image.open(spill.name if spill is not None else io.BytesIO(buffer)):
+                pass
+        except (UnidentifiedImageError, OSError):
+            raise InvalidImage from None
+
+    except:
+        if spill is not None:
+            spill.close()
+            os.remove(spill.name)
+        raise
 
-async def do_ocr(path: pathlib.Path, loop: asyncio.AbstractEventLoop):
-    return await loop.run_in_executor(pool, _do_img, path)
+    return spill.name if spill is not None else bytes(buffer)
\ No newline at end of file
@@ -0,0 +1,85 @@
+import asyncio
+import datetime
+import logging
+from typing import Dict, List, Optional, TYPE_CHECKING
+
+import asyncpg
+
+if TYPE_CHECKING:
+    from utils.app import App
+
+logger = logging.getLogger("site.partitions")
+
+WEEK = datetime.timedelta(weeks=1)
+
+def week_start(when: datetime.datetime) -> datetime.datetime:
+    when = when.replace(hour=0, minute=0, second=0, microsecond=0)
+    return when - datetime.timedelta(days=when.weekday())
+
+def partition_name(table: str, week: datetime.datetime) -> str:
+    return f"{table}_p{week:%Y%m%d}"
+
+class LogPartitions:
+    """
+    Maintains the weekly partitions of the log tables.
+    Partitions are created ``ahead`` weeks in advance, so rows never land in the default partition, and partitions that
+    ended more than the table's retention (in days) ago are dropped, which is far cheaper than deleting the rows.
+    """
+    def __init__(self, app: "App", retention: Dict[str, int], ahead: int = 2, interval: float = 3600):
+        self.app = app
+        self.retention = retention
+        self.ahead = ahead
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        try:
+            await self.maintain()
+        except Exception as e: # the default partition still takes the rows, so don't hold up startup
+            logger.error("Failed to maintain the log partitions", exc_info=e)
+
+        self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.maintain()
+            except Exception as e:
+                logger.error("Failed to maintain the log partitions", exc_info=e)
+
+    async def partitions(self, conn: asyncpg.Connection, table: str) -> List[str]:
+        return [r['relname'] for r in await conn.fetch("""
+        SELECT child.relname FROM pg_inherits
+        INNER JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        INNER JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = $1
+        """, table)]
+
+    async def maintain(self):
+        now = datetime.datetime.utcnow()
+        async with self.app.db.acquire() as conn:
+            for table, days in self.retention.items():
+                existing = set(await self.partitions(conn, table))
+
+                week = week_start(now)
+                for _ in range(self.ahead + 1):
+                    name = partition_name(table, week)
+                    if name not in existing:
+                        await conn.execute(
+                            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+                            f"FOR VALUES FROM ('{week.isoformat()}') TO ('{(week + WEEK).isoformat()}')"
+                        )
+                        logger.info(f"Created partition {name}")
+                    week += WEEK
+
+                cutoff = now - datetime.timedelta(days=days)
+                for name in existing:
+                    try:
+                        week = datetime.datetime.strptime(name[len(table) + 2:], "%Y%m%d")
+                    except ValueError: # the default partition
+                        continue
+
+                    if name.startswith(f"{table}_p") and week + WEEK <= cutoff:
+                        await conn.execute(f"DROP TABLE {name}")
+                        logger.info(f"Dropped partition {name}")
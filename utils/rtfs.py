@@ -1,31 +1,52 @@
 import ast
 import asyncio
 import difflib
+import functools
+import heapq
 import configparser
 import os
-import subprocess
 import time
+import uuid
 import logging
 import re
+import shutil
 from os import PathLike
-from typing import Union, List, Dict
+from typing import Union, List, Dict, Optional, TYPE_CHECKING
 
+import asyncpg
 from aiohttp import web
 
+if TYPE_CHECKING:
+    from utils.app import App
+
 logger = logging.getLogger("site.rtfs")
 logger.setLevel(10)
 
+@functools.lru_cache(maxsize=64)
+def _file_lines(path: str, mtime: int) -> List[str]:
+    # mtime is part of the cache key so that a git pull invalidates the cached lines
+    with open(path, encoding="utf8") as f:
+        return f.read().split("\n")
+
 class Node:
-    file: str
-    line: int
-    end_line: int
-    name: str
-    url: str
-    source: str
+    __slots__ = ("index", "file", "line", "end_line", "name")
 
-    def __init__(self, **kwargs):
-        for a, b in kwargs.items():
-            setattr(self, a, b)
+    def __init__(self, index: "Index", file: Optional[str], line: int, end_line: int, name: str):
+        self.index = index
+        self.file = file
+        self.line = line
+        self.end_line = end_line
+        self.name = name
+
+    @property
+    def url(self) -> str:
+        return f"{self.index.repo_url}/blob/{self.index.branch}/{self.file}#L{self.line}-L{self.end_line}"
+
+    @property
+    def source(self) -> str:
+        path = os.path.join(self.index.source_path, self.file)
+        lines = _file_lines(path, os.stat(path).st_mtime_ns)
+        return "\n".join(lines[self.line-1:self.end_line])
 
     def __repr__(self):
         return f"<Node file={self.file} line={self.line} end_line={self.end_line} name={self.name} url={self.url}>"
@@ -33,6 +54,62 @@ class Node:
 def _get_attr_name(attr: ast.Attribute):
     if type(attr.value) is ast.Attribute:
         return _get_attr_name(attr.value)
+
+def _ngrams(word: str, n: int) -> set:
+    word = f" {word.lower()} "
+    return {word[i:i+n] for i in range(max(len(word) - n + 1, 1))}
+
+class FuzzyIndex:
+    """
+    An n-gram inverted index over node names.
+    Candidates are shortlisted by n-gram overlap, and only the shortlist gets scored with difflib,
+    so queries don't have to run a SequenceMatcher against every name in the library.
+    """
+    __slots__ = ("keys", "n", "shortlist", "_postings", "_sizes")
+
+    def __init__(self, keys: List[str], n: int = 3, shortlist: int = 64):
+        self.keys = keys
+        self.n = n
+        self.shortlist = shortlist
+        self._postings: Dict[str, List[int]] = {}
+        self._sizes: List[int] = []
+
+        for i, key in enumerate(keys):
+            grams = _ngrams(key, n)
+            self._sizes.append(len(grams))
+            for gram in grams:
+                self._postings.setdefault(gram, []).append(i)
+
+    def find(self, word: str, limit: int = 3, cutoff: float = 0.55) -> List[str]:
+        grams = _ngrams(word, self.n)
+        shared: Dict[int, int] = {}
+        for gram in grams:
+            for i in self._postings.get(gram, ()):
+                shared[i] = shared.get(i, 0) + 1
+
+        if not shared:
+            return []
+
+        size = len(grams)
+        sizes = self._sizes
+        candidates = heapq.nlargest(
+            self.shortlist,
+            shared.items(),
+            key=lambda t: t[1] / (size + sizes[t[0]] - t[1]) # jaccard similarity
+        )
+
+        matcher = difflib.SequenceMatcher()
+        matcher.set_seq2(word)
+        results = []
+        for i, _ in candidates:
+            matcher.set_seq1(self.keys[i])
+            if matcher.real_quick_ratio() >= cutoff and matcher.quick_ratio() >= cutoff:
+                ratio = matcher.ratio()
+                if ratio >= cutoff:
+                    results.append((ratio, self.keys[i]))
+
+        return [key for _, key in heapq.nlargest(limit, results)]
+
 class Index:
     def __init__(self, repo_path: str, index_folder: str, repo_url: str, branch: str=None, version=None):
         self.repo_path = repo_path
@@ -43,23 +120,57 @@ class Index:
 
         self.repo_url = repo_url.strip("/")
         self.version = version
+        self._args = (repo_path, index_folder, repo_url, branch, version)
+        self.source_path = repo_path # where this generation's files live, see checkout_generation
+
+        self.branch = branch
+        self.commit = None
+        self.prepared = False
+        self.nodes: Dict[str, Node] = {}
+
+    async def _git(self, *args: str, cwd: str = None) -> bool:
+        proc = await asyncio.create_subprocess_exec("git", *args, cwd=cwd)
+        return await proc.wait() == 0
 
+    async def _git_output(self, *args: str, cwd: str = None) -> Optional[str]:
+        proc = await asyncio.create_subprocess_exec("git", *args, cwd=cwd, stdout=asyncio.subprocess.PIPE)
+        out, _ = await proc.communicate()
+        return out.decode().strip() if proc.returncode == 0 else None
+
+    @property
+    def generations_path(self) -> str:
+        return self.repo_path.rstrip("/") + ".generations"
+
+    async def prepare(self, pull: bool = False) -> bool:
+        """
+        Clones the repo if it doesn't exist yet (or pulls it if ``pull`` is passed), then reads the branch and commit.
+        Returns whether the git operations succeeded.
+        """
+        ok = True
         if not os.path.exists(self.repo_path):
-            subprocess.run(["git", "clone", self.repo_url, self.repo_path])
+            ok = await self._git("clone", "--", self.repo_url, self.repo_path)
 
-            if branch:
-                subprocess.run(["/bin/bash", "-c", f"cd {self.repo_path} && git checkout {branch}"])
+            if ok and self.branch:
+                # the trailing -- makes git read the branch as a revision, never as a path
+                ok = await self._git("checkout", self.branch, "--", cwd=self.repo_path)
 
+        elif pull:
+            # nothing is serving from the old generations anymore
+            shutil.rmtree(self.generations_path, ignore_errors=True)
+            await self._git("worktree", "prune", cwd=self.repo_path)
+            ok = await self._git("pull", cwd=self.repo_path)
+
+        branch = self.branch
         if not branch:
-            if not os.path.exists(os.path.join(repo_path, ".git")):
+            if not os.path.exists(os.path.join(self.repo_path, ".git")):
                 raise ValueError("not a git repo, no branch")
 
-            with open(os.path.join(repo_path, ".git", "HEAD"), encoding="utf8") as f:
+            with open(os.path.join(self.repo_path, ".git", "HEAD"), encoding="utf8") as f:
                 v = f.read()
             try:
                 branch = v.split("ref: refs/heads/")[1].strip()
             except:
-                with open(os.path.join(repo_path, ".git", "config"), encoding="utf8") as f:
+                with open(os.path.join(self.repo_path, ".git", "config"), encoding="utf8") as f:
                     c = configparser.ConfigParser()
                     c.read_file(f)
 
@@ -72,9 +183,36 @@ class Index:
         except:
             self.commit = None
 
-        self.nodes: Dict[str, Node] = {}
+        self.prepared = True
+        return ok
+
+    async def checkout_generation(self) -> bool:
+        """
+        Fetches the latest commit of the branch and checks it out into its own worktree, instead of pulling into
+        the checkout the current generation reads its source from. Must be called after :meth:`prepare`.
+        """
+        if not await self._git("fetch", "origin", cwd=self.repo_path):
+            return False
+
+        commit = await self._git_output("rev-parse", f"origin/{self.branch}", cwd=self.repo_path)
+        if commit is None:
+            return False
 
-    async def index_class_function(self, nodes: dict, cls: ast.ClassDef, src: List[str], fn: Union[ast.FunctionDef, ast.AsyncFunctionDef]):
+        path = os.path.join(self.generations_path, commit)
+        if not os.path.exists(path):
+            os.makedirs(self.generations_path, exist_ok=True)
+            if not await self._git("worktree", "add", "--detach", "--", os.path.abspath(path), commit, cwd=self.repo_path):
+                return False
+
+        self.source_path = path
+        self.commit = commit
+        return True
+
+    async def remove_generation(self):
+        if self.source_path != self.repo_path:
+            await self._git("worktree", "remove", "--force", os.path.abspath(self.source_path), cwd=self.repo_path)
+
+    async def index_class_function(self, nodes: dict, cls: ast.ClassDef, fn: Union[ast.FunctionDef, ast.AsyncFunctionDef]):
         clsname = cls.name
 
         for b in fn.body:
@@ -86,15 +224,15 @@ class Index:
                     name = clsname + "." + t0.attr
                     if name not in nodes:
                         n = Node(
+                            index=self,
                             file=None,
                             line=b.lineno,
                             end_line=b.end_lineno,
-                            name=name,
-                            source="\n".join(src[b.lineno-1:b.end_lineno])
+                            name=name
                         )
                         nodes[name] = n
 
-    async def index_class(self, nodes: dict, src: List[str], cls: ast.ClassDef):
+    async def index_class(self, nodes: dict, cls: ast.ClassDef):
         clsname = cls.name
 
         for b in cls.body:
@@ -103,53 +241,52 @@ class Index:
                 name = clsname + "." + b.targets[0].id
                 if name not in nodes:
                     n = Node(
+                        index=self,
                         file=None,
                         line=b.lineno,
                         end_line=b.end_lineno,
-                        name=name,
-                        source="\n".join(src[b.lineno-1:b.end_lineno])
+                        name=name
                     )
                     nodes[name] = n
 
             elif t in (ast.FunctionDef, ast.AsyncFunctionDef):
                 if not b.name.startswith("__"):
                     nodes[clsname + "." + b.name] = Node(
+                        index=self,
                         file=None,
                         line=b.lineno,
                         end_line=b.end_lineno,
-                        name=clsname + "." + b.name,
-                        source="\n".join(src[b.lineno-1:b.end_lineno])
+                        name=clsname + "." + b.name
                     )
-                await self.index_class_function(nodes, cls, src, b)
+                await self.index_class_function(nodes, cls, b)
 
     async def index_file(self, _nodes: dict, fp: Union[str, PathLike], dirs: List[str], is_utils: bool = False):
         nodes = {}
         with open(fp, encoding="utf8") as f:
             src = f.read()
 
-        lines = src.split("\n")
         node = ast.parse(src)
 
         for b in node.body:
             if type(b) is ast.ClassDef:
                 nodes[b.name] = Node(
+                    index=self,
                     file=None,
                     line=b.lineno,
                     end_line=b.end_lineno,
-                    name=b.name,
-                    source="\n".join(lines[b.lineno-1:b.end_lineno])
+                    name=b.name
                 )
-                await self.index_class(nodes, lines, b)
+                await self.index_class(nodes, b)
 
             elif type(b) is ast.Assign and isinstance(b.targets[0], ast.Name):
                 name = b.targets[0].id
                 if name not in nodes:
                     n = Node(
+                        index=self,
                         file=None,
                         line=b.lineno,
                         end_line=b.end_lineno,
-                        name=name,
-                        source="\n".join(lines[b.lineno-1:b.end_lineno])
+                        name=name
                     )
                     nodes[name] = n
 
@@ -161,15 +298,15 @@ class Index:
 
                 if name not in nodes:
                     n = Node(
+                        index=self,
                         file=fp,
                         line=b.lineno,
                         end_line=b.end_lineno,
-                        name=name,
-                        source="\n".join(lines[b.lineno - 1:b.end_lineno])
+                        name=name
                     )
                     nodes[name] = n
 
-        pth = "/".join(dirs)
+        pth = "/".join(d for d in dirs if d) # an index_folder of "" adds an empty first part
         for n in nodes.values():
             n.file = pth
 
@@ -192,12 +329,10 @@ class Index:
                 await self.index_file(nodes, os.path.join(target, f), parents+[f], f == "utils.py")
 
     async def index_lib(self):
-        await self.index_directory(self.nodes, self.repo_path, [], self.index_folder)
-
-        for name, n in self.nodes.items():
-            n.url = f"{self.repo_url}/blob/{self.branch}/{n.file}#L{n.line}-L{n.end_line}"
+        await self.index_directory(self.nodes, self.source_path, [], self.index_folder)
 
         self.keys = list(self.nodes.keys())
+        self.matcher = FuzzyIndex(self.keys)
         if not self.version and '__version__' in self.nodes:
             v = re.search("__version__\s*=\s*'|\"((\d|\.)*)'|\"", self.nodes['__version__'].source)
             if v:
@@ -205,64 +340,235 @@ class Index:
             else:
                 print(self.nodes['__version__'], self.nodes['__version__'].source)
 
+    def fresh(self) -> "Index":
+        """
+        Creates a new, unindexed copy of this index, reading from the main checkout until
+        :meth:`checkout_generation` moves it to its own worktree.
+        """
+        return Index(*self._args)
+
     def find_matches(self, word: str) -> List[Node]:
-        vals = difflib.get_close_matches(word, self.keys, cutoff=0.55)
+        vals = self.matcher.find(word, cutoff=0.55)
         return [self.nodes[v] for v in vals]
 
+LIBRARY_NAME_RE = re.compile(r"[a-z0-9][a-z0-9._-]{0,63}")
+BRANCH_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9._/-]{0,127}")
+
+class BuildFailed(Exception):
+    def __init__(self, name: str, reason: str, retry_after: int):
+        self.reason = reason
+        self.retry_after = retry_after
+        super().__init__(f"Library {name} failed to index ({reason}), retrying in {retry_after} seconds")
+
+def _relative_path(path: str) -> bool:
+    path = os.path.normpath(path)
+    return not os.path.isabs(path) and path != ".." and not path.startswith(".." + os.sep)
+
 class Indexes:
-    __indexable = {
-        "discord.py-2": Index("repos/discord.py-2", "discord", "https://github.com/Rapptz/discord.py/"),
-        "discord.py": Index("repos/discord.py", "discord", "https://github.com/Rapptz/discord.py/"),
-        "twitchio": Index("repos/TwitchIO", "twitchio", "https://github.com/TwitchIO/TwitchIO/"),
-        "wavelink": Index("repos/Wavelink", "wavelink", "https://github.com/PythonistaGuild/Wavelink/"),
-        "aiohttp": Index("repos/aiohttp", "aiohttp", "https://github.com/aio-libs/aiohttp/"),
-        "enhanced-discord.py": Index("repos/enhanced-discord.py", "discord", "https://github.com/Idevision/Enhanced-discord.py", branch="2.0")
-    }
-
-    def __init__(self):
+    """
+    The registry of rtfs libraries. Libraries are loaded from the ``rtfs_libraries`` table,
+    and are cloned and indexed the first time they're queried (or at startup, if they're in the ``rtfs_warmup`` setting).
+    """
+    def __init__(self, app: "App"):
+        self.app = app
+        self.libraries: Dict[str, Index] = {}
         self.index: Dict[str, Index] = {}
-        self._is_indexed = False
+        self.jobs: Dict[str, dict] = {}
+        self._building: Dict[str, asyncio.Task] = {}
+        self._failures: Dict[str, tuple] = {} # name: (failure count, retry at, reason)
+        self._is_loaded = False
+        self._lock = asyncio.Lock()
         self._loop = asyncio.get_event_loop()
-        self._loop.create_task(self._do_index())
+        self._loop.create_task(self._load())
 
     @property
     def indexed(self):
-        return self._is_indexed
+        return self._is_loaded and not self._building
 
     @property
     def libs(self):
-        return ", ".join(self.__indexable.keys())
+        return ", ".join(self.libraries.keys())
 
     @property
     def lib_index(self):
         return {
-            x: y.version for x, y in self.__indexable.items()
+            x: (self.index[x] if x in self.index else y).version for x, y in self.libraries.items()
         }
 
     def get_query(self, lib: str, query: str, as_text: bool = False):
-        if not self._is_indexed:
+        if not self._is_loaded:
             raise RuntimeError("Indexing is not complete")
 
-        if lib not in self.index:
+        index = self.index.get(lib) # hold onto this generation in case a reload swaps it out
+        if index is None:
+            if lib in self.libraries:
+                self._ensure_built(lib)
+                if lib in self._failures and lib not in self._building:
+                    _, retry_at, reason = self._failures[lib]
+                    raise BuildFailed(lib, reason, max(1, int(retry_at - time.monotonic())))
+
+                raise RuntimeError("Indexing is not complete")
+
             return None
 
         start = time.monotonic()
-        resp = self.index[lib].find_matches(query)
+        resp = index.find_matches(query)
         end = time.monotonic() - start
         return web.json_response({
             "nodes": {x.name: (x.url if not as_text else x.source) for x in resp},
             "query_time": end,
-            "commit": self.index[lib].commit
+            "commit": index.commit
         })
 
-    async def _do_index(self, *_):
-        logger.info("Start Index")
-        amount = len(self.__indexable)
-        for n, (name, index) in enumerate(self.__indexable.items()):
-            logger.info(f"Indexing module {name} ({n+1}/{amount})")
-            self.index[name] = index
+    async def add_library(self, conn: asyncpg.Connection, name: str, repo_url: str, index_folder: str,
+                          repo_path: str = None, branch: str = None, version: str = None) -> Index:
+        """
+        Adds or replaces a library. ``name``, ``repo_path`` and ``index_folder`` end up as paths on disk,
+        and ``repo_url`` and ``branch`` end up as git arguments, so they're validated,
+        and :class:`ValueError` is raised if they'd point outside the repos folder or could be read as git options.
+        """
+        if not LIBRARY_NAME_RE.fullmatch(name):
+            raise ValueError("name may only contain lowercase letters, numbers, '.', '_' and '-'")
+
+        if not repo_url.startswith("https://"):
+            raise ValueError("url must be an https:// url")
+
+        if branch is not None and (not BRANCH_RE.fullmatch(branch) or ".." in branch):
+            raise ValueError("branch may only contain letters, numbers, '.', '_', '/' and '-'")
+
+        repo_path = repo_path or f"repos/{name}"
+        normalized = os.path.normpath(repo_path)
+        if not _relative_path(repo_path) or not normalized.startswith("repos" + os.sep):
+            raise ValueError("path must be inside the repos folder")
+
+        if not _relative_path(index_folder):
+            raise ValueError("folder must be a path inside the repository")
+
+        repo_path = normalized
+        await conn.execute(
+            "INSERT INTO rtfs_libraries VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT (name) DO UPDATE SET "
+            "repo_path = $2, index_folder = $3, repo_url = $4, branch = $5, version = $6",
+            name, repo_path, index_folder, repo_url, branch, version
+        )
+        index = Index(repo_path, index_folder, repo_url, branch=branch, version=version)
+        self.libraries[name] = index
+        self.index.pop(name, None)
+        self._failures.pop(name, None)
+        task = self._building.pop(name, None)
+        if task is not None:
+            task.cancel()
+
+        self._ensure_built(name)
+        return index
+
+    async def remove_library(self, conn: asyncpg.Connection, name: str) -> bool:
+        if not await conn.fetchval("DELETE FROM rtfs_libraries WHERE name = $1 RETURNING name", name):
+            return False
+
+        self.libraries.pop(name, None)
+        self.index.pop(name, None)
+        self._failures.pop(name, None)
+        task = self._building.pop(name, None)
+        if task is not None:
+            task.cancel()
+
+        return True
+
+    def reload(self) -> str:
+        """
+        Starts pulling and reindexing every indexed library in the background.
+        The current indexes keep serving queries until their replacement is built.
+        Returns a job id that can be passed to :meth:`get_job`.
+        """
+        job_id = uuid.uuid4().hex[:12]
+        self.jobs[job_id] = {
+            "status": "pending",
+            "started": time.time(),
+            "finished": None,
+            "success": [],
+            "fail": [],
+            "commits": {}
+        }
+        while len(self.jobs) > 20:
+            del self.jobs[next(iter(self.jobs))]
+
+        self._loop.create_task(self._do_reload(job_id))
+        return job_id
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        return self.jobs.get(job_id)
+
+    def _ensure_built(self, name: str):
+        failure = self._failures.get(name)
+        if failure is not None and time.monotonic() < failure[1]:
+            return # backing off after a failed build
+
+        if name not in self._building:
+            self._building[name] = self._loop.create_task(self._build(name, self.libraries[name], pull=True))
+
+    async def _load(self):
+        data = await self.app.db.fetch("SELECT * FROM rtfs_libraries")
+        for record in data:
+            self.libraries[record['name']] = Index(
+                record['repo_path'],
+                record['index_folder'],
+                record['repo_url'],
+                branch=record['branch'],
+                version=record['version']
+            )
+
+        self._is_loaded = True
+        logger.info(f"Loaded {len(self.libraries)} rtfs libraries")
+
+        for name in self.app.settings.get("rtfs_warmup", []):
+            if name in self.libraries:
+                self._ensure_built(name)
+
+    async def _build(self, name: str, index: Index, pull: bool = False, generation: bool = False) -> bool:
+        try:
+            logger.info(f"Indexing module {name}")
+            ok = await index.prepare(pull and not generation)
+            if ok and generation:
+                ok = await index.checkout_generation()
+
             await index.index_lib()
+        except Exception as e:
+            logger.error(f"Failed to index module {name}", exc_info=e)
+            if name not in self.index: # nothing to fall back on, so don't retry on every query
+                count = self._failures.get(name, (0,))[0] + 1
+                backoff = min(60 * 2 ** (count - 1), 3600)
+                self._failures[name] = (count, time.monotonic() + backoff, type(e).__name__)
+            return False
+        finally:
+            if self._building.get(name) is asyncio.current_task():
+                del self._building[name]
+
+        if self.libraries.get(name) is not None and index._args == self.libraries[name]._args:
+            old = self.index.get(name)
+            self.index[name] = index # swap in the finished generation
+            self._failures.pop(name, None)
             logger.info(f"Finished indexing module {name} ({len(index.nodes)} nodes)")
+            # source reads are synchronous, so nothing can still be reading from the old generation's worktree
+            if old is not None and old.source_path != index.source_path:
+                await old.remove_generation()
+
+        return ok
+
+    async def _do_reload(self, job_id: str):
+        job = self.jobs[job_id]
+        async with self._lock:
+            job['status'] = "running"
+            try:
+                for name, index in list(self.index.items()):
+                    if await self._build(name, index.fresh(), pull=True, generation=True):
+                        job['success'].append(name)
+                    else:
+                        job['fail'].append(name)
+            except Exception as e:
+                logger.error("Failed to reload the rtfs index", exc_info=e)
+                job['status'] = "failed"
+            else:
+                job['status'] = "complete"
 
-        logger.info("Finish Index")
-        self._is_indexed = True
+            job['finished'] = time.time()
+            job['commits'] = {name: value.commit for name, value in self.index.items()}
@@ -1,14 +1,21 @@
 import aiohttp
 import asyncio
 import datetime
+import heapq
+import logging
+import math
 import time
 import re
+
+import asyncpg
 from aiohttp import web
 
-from typing import TYPE_CHECKING
+from typing import Dict, List, Optional, Tuple, TYPE_CHECKING
 if TYPE_CHECKING:
     from utils import app
 
+logger = logging.getLogger("site.xkcd")
+
 # slight alterations to finder
 def finder(text, collection, *, key=None):
     suggestions = []
@@ -25,54 +32,238 @@ def finder(text, collection, *, key=None):
     return [z for _, _, z in sorted(suggestions)]
 
 
+TOKEN_RE = re.compile(r"\w+")
+
+def tokenize(text: Optional[str]) -> List[str]:
+    return TOKEN_RE.findall(text.lower()) if text else []
+
+
+class FullTextIndex:
+    """
+    An inverted index over comic text, ranked with BM25.
+    Fields are weighted by repeating their term frequencies, so a title hit counts for more than a transcript hit.
+    """
+    __slots__ = ("k1", "b", "_postings", "_lengths", "_total")
+
+    TITLE_WEIGHT = 3
+    TAG_WEIGHT = 2
+    TEXT_WEIGHT = 1
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._lengths: Dict[int, int] = {}
+        self._total = 0
+
+    def add(self, num: int, text: Optional[str], weight: int):
+        terms = tokenize(text)
+        for term in terms:
+            postings = self._postings.setdefault(term, {})
+            postings[num] = postings.get(num, 0) + weight
+
+        self._lengths[num] = self._lengths.get(num, 0) + len(terms) * weight
+        self._total += len(terms) * weight
+
+    def add_comic(self, comic: "Comic"):
+        self.add(comic.num, comic.title, self.TITLE_WEIGHT)
+        self.add(comic.num, comic.alt, self.TEXT_WEIGHT)
+        self.add(comic.num, comic.transcript, self.TEXT_WEIGHT)
+        for tag in comic.extra_tags:
+            self.add(comic.num, tag, self.TAG_WEIGHT)
+
+    def search(self, query: str, limit: int = 8) -> List[int]:
+        if not self._lengths:
+            return []
+
+        count = len(self._lengths)
+        avg = self._total / count
+        k1, b = self.k1, self.b
+        scores: Dict[int, float] = {}
+
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for num, tf in postings.items():
+                norm = k1 * (1 - b + b * self._lengths[num] / avg)
+                scores[num] = scores.get(num, 0) + idf * tf * (k1 + 1) / (tf + norm)
+
+        return [num for num, _ in heapq.nlargest(limit, scores.items(), key=lambda t: t[1])]
+
+
+XKCD_COLUMNS = ("num", "posted", "safe_title", "title", "alt", "transcript", "news", "image_url", "url")
+
+def formatter(_data: dict) -> list:
+    d = datetime.datetime(year=int(_data['year']), month=int(_data['month']), day=int(_data['day']), minute=0, hour=0,
+                          second=0)
+    return [_data['num'], d, _data['safe_title'], _data['title'], _data['alt'], _data['transcript'] or None,
+            _data['news'] or None, _data['img'], f"https://xkcd.com/{_data['num']}"]
+
+
+class XKCDSync:
+    """
+    Finds the comics missing from the xkcd table, fetches them concurrently and bulk inserts them.
+    Progress is written after every batch, so an interrupted sync picks up where it left off.
+    """
+    SKIP = {404} # xkcd 404 is intentionally missing
+
+    def __init__(self, db: asyncpg.Pool, session: aiohttp.ClientSession, base_url: str = "https://xkcd.com",
+                 concurrency: int = 8, batch_size: int = 100):
+        self.db = db
+        self.session = session
+        self.base_url = base_url.rstrip("/")
+        self.batch_size = batch_size
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(self, num: int = None) -> Optional[dict]:
+        url = f"{self.base_url}/{num}/info.0.json" if num else f"{self.base_url}/info.0.json"
+        async with self._semaphore:
+            async with self.session.get(url) as resp:
+                if resp.status == 404:
+                    return None
+
+                resp.raise_for_status()
+                return await resp.json(content_type=None)
+
+    async def missing(self, latest: int) -> List[int]:
+        data = await self.db.fetch(
+            "SELECT s.num FROM generate_series(1, $1) AS s(num) "
+            "LEFT JOIN xkcd ON xkcd.num = s.num WHERE xkcd.num IS NULL AND s.num <> ALL($2) ORDER BY s.num",
+            latest, list(self.SKIP)
+        )
+        return [x['num'] for x in data]
+
+    async def sync(self) -> List[dict]:
+        """
+        Fetches and inserts every missing comic. Returns the inserted comics as records.
+        """
+        latest = await self.fetch()
+        missing = await self.missing(latest['num'])
+        if missing:
+            logger.info(f"Syncing {len(missing)} missing xkcd comics")
+
+        inserted = []
+        for i in range(0, len(missing), self.batch_size):
+            batch = await asyncio.gather(*(self.fetch(num) for num in missing[i:i+self.batch_size]))
+            rows = [formatter(x) for x in batch if x is not None]
+            if not rows:
+                continue
+
+            await self.db.executemany(
+                f"INSERT INTO xkcd ({', '.join(XKCD_COLUMNS)}) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9) ON CONFLICT (num) DO NOTHING",
+                rows
+            )
+            inserted += [{**dict(zip(XKCD_COLUMNS, row)), "extra_tags": []} for row in rows]
+
+        return inserted
+
+
+class Comic:
+    __slots__ = ("num", "posted", "safe_title", "title", "alt", "transcript", "news", "image_url", "url", "extra_tags")
+
+    def __init__(self, record):
+        self.num: int = record['num']
+        self.posted: datetime.datetime = record['posted']
+        self.safe_title: str = record['safe_title']
+        self.title: str = record['title']
+        self.alt: str = record['alt']
+        self.transcript: Optional[str] = record['transcript']
+        self.news: Optional[str] = record['news']
+        self.image_url: str = record['image_url']
+        self.url: str = record['url']
+        self.extra_tags: List[str] = list(record['extra_tags'])
+
+    def to_dict(self) -> dict:
+        return {
+            "num": self.num,
+            "posted": self.posted.isoformat(),
+            "safe_title": self.safe_title,
+            "title": self.title,
+            "alt": self.alt,
+            "transcript": self.transcript,
+            "news": self.news,
+            "image_url": self.image_url,
+            "url": self.url
+        }
+
+
 class XKCD:
     def __init__(self, app):
         self.app = app
         self.app.loop.create_task(self.task())
-        self._cache = {}
-
-    def formatter(self, _data: dict):
-        d = datetime.datetime(year=int(_data['year']), month=int(_data['month']), day=int(_data['month']), minute=0, hour=0,
-                              second=0)
-        return [_data['num'], d, _data['safe_title'], _data['title'], _data['alt'], _data['transcript'] or None,
-                _data['news'] or None, _data['img'], f"https://xkcd.com/{_data['num']}"]
+        self._comics: Dict[int, Comic] = {}
+        self._index: List[Tuple[str, int]] = [] # (title or tag, num)
+        self._fulltext = FullTextIndex()
+        self._built = False
+        self._lock = asyncio.Lock()
 
     async def task(self):
         self.session = aiohttp.ClientSession(headers={"user-agent": "Idevision.net XKCD index"})
+        self.sync = XKCDSync(self.app.db, self.session)
+        await self.build()
+
+        interval = self.app.settings.get("xkcd_sync_interval", 60*60*3)
+        while True:
+            try:
+                for record in await self.sync.sync():
+                    self.add_comic(record)
+            except Exception as e:
+                logger.error("Failed to sync xkcd comics", exc_info=e)
+
+            await asyncio.sleep(interval)
+
+    def add_comic(self, record):
+        comic = Comic(record)
+        self._comics[comic.num] = comic
+        self._index.append((comic.title, comic.num))
+        for tag in comic.extra_tags:
+            self._index.append((tag, comic.num))
+
+        self._fulltext.add_comic(comic)
 
-        await asyncio.sleep(60*60*24)
-        async with self.session.get("https://xkcd.com/info.0.json") as resp:
-            data = await resp.json()
-            data = self.formatter(data)
-            v = await self.app.db.fetchrow("INSERT INTO xkcd VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9) ON CONFLICT DO NOTHING RETURNING *;", *data)
-            if v:
-                self._cache[v['title']] = v['num']
+    def add_tag(self, num: int, tag: str):
+        """
+        Binds a tag to a comic in the in-memory index. The caller is responsible for writing it to the database.
+        """
+        if not self._built or num not in self._comics:
+            return
 
-    async def build(self, request: "app.TypedRequest"):
-        data = await request.conn.fetch("SELECT num, title, extra_tags FROM xkcd")
-        for v in data:
-            self._cache[v['title']] = v['num']
-            for x in v['extra_tags']:
-                self._cache[x] = v['num']
+        self._comics[num].extra_tags.append(tag)
+        self._index.append((tag, num))
+        self._fulltext.add(num, tag, FullTextIndex.TAG_WEIGHT)
 
+    async def build(self):
+        async with self._lock:
+            if self._built:
+                return
 
-    async def search_xkcd(self, query: str, request: "app.TypedRequest") -> web.Response:
+            data = await self.app.db.fetch(
+                "SELECT num, posted, safe_title, title, alt, transcript, news, image_url, url, extra_tags FROM xkcd"
+            )
+            for v in data:
+                self.add_comic(v)
+
+            self._built = True
+
+    async def search_xkcd(self, query: str, request: "app.TypedRequest", fulltext: bool = False) -> web.Response:
         start = time.time()
-        if not self._cache:
-            await self.build(request)
-
-        v = finder(query, list(self._cache.items()), key=lambda t: t[0])[:8]
-        nodes = await request.conn.fetch(
-            "SELECT "
-            "num, posted, safe_title, title, alt, transcript, news, image_url, url "
-            "FROM xkcd WHERE num = ANY($1)",
-            v
-        )
+        if not self._built:
+            await self.build()
+
+        if fulltext:
+            nums = self._fulltext.search(query)
+        else:
+            nums = []
+            for num in finder(query, self._index, key=lambda t: t[0]):
+                if num not in nums:
+                    nums.append(num)
+                    if len(nums) == 8:
+                        break
+
+        r = [self._comics[num].to_dict() for num in nums]
         end = time.time()
-        r = []
-        for x in nodes:
-            d = dict(x)
-            d['posted'] = d['posted'].isoformat()
-            r.append(d)
 
         return web.json_response({"nodes": r, "query_time": end-start})